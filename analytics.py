@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+File: analytics.py
+
+Description:
+Session analytics over the journal of process_monitor.py. The journal
+records when each browser started and stopped running for each user;
+here those transitions are turned into browsing sessions, one interval
+per browser run, kept as columns of NumPy arrays rather than as Python
+objects. Everything is then computed over whole columns at once: how
+long sessions of each browser last, how soon a user starts another
+browser after closing Tor Browser, and how long browsers run at the
+same time. Months of journal take a few arrays of a few megabytes.
+
+The sessions and the results can be exported to a compressed .npz file
+for the study analysis.
+
+Example:
+    python3 analytics.py ~/.tor_measure/journal --export sessions.npz
+"""
+import argparse
+import time
+
+import numpy
+
+import journal
+
+TOR = journal.BROWSERS.index('tor')
+
+# This class holds browsing sessions as columns: the user and browser of
+# each session, when it started and ended, and whether it was still
+# running when the journal ends, in which case its end is that time.
+class SessionTable:
+    def __init__(self, user, browser, start, end, running):
+        self.user = user
+        self.browser = browser
+        self.start = start
+        self.end = end
+        self.running = running
+
+    def __len__(self):
+        return len(self.start)
+
+    def durations(self):
+        return self.end - self.start
+
+    # Returns the number of sessions and the mean, median, 90th
+    # percentile and total of the durations of the finished sessions of
+    # every browser that has any.
+    def duration_summary(self):
+        durations = self.durations()
+        finished = ~self.running
+        summary = {}
+        for index, name in enumerate(journal.BROWSERS):
+            selected = durations[finished & (self.browser == index)]
+            if not len(selected):
+                continue
+            summary[name] = {
+                'sessions': len(selected),
+                'mean': float(selected.mean()),
+                'median': float(numpy.median(selected)),
+                'p90': float(numpy.percentile(selected, 90)),
+                'total': float(selected.sum()),
+            }
+        return summary
+
+    # Returns, for every finished Tor Browser session, how long it took
+    # the same user to start another browser afterwards (NaN if they
+    # never did), and whether another browser was already running when
+    # Tor Browser was closed.
+    def switch_latencies(self):
+        tor = (self.browser == TOR) & ~self.running
+        latencies = numpy.full(numpy.count_nonzero(tor), numpy.nan)
+        already = numpy.zeros(len(latencies), dtype=bool)
+        tor_user = self.user[tor]
+        tor_end = self.end[tor]
+        for user in numpy.unique(tor_user):
+            mine = tor_user == user
+            ends = tor_end[mine]
+            other = (self.user == user) & (self.browser != TOR)
+            order = numpy.argsort(self.start[other], kind='stable')
+            starts = self.start[other][order]
+            other_ends = self.end[other][order]
+            # The next start after each close.
+            following = numpy.searchsorted(starts, ends, side='left')
+            found = following < len(starts)
+            user_latencies = numpy.full(len(ends), numpy.nan)
+            user_latencies[found] = starts[following[found]] - ends[found]
+            latencies[mine] = user_latencies
+            # Whether a session that started before the close was still
+            # running then: the latest end among the sessions started so
+            # far is after the close.
+            before = numpy.searchsorted(starts, ends, side='right') - 1
+            latest = numpy.maximum.accumulate(other_ends)
+            user_already = numpy.zeros(len(ends), dtype=bool)
+            seen = before >= 0
+            user_already[seen] = latest[before[seen]] > ends[seen]
+            already[mine] = user_already
+        return latencies, already
+
+    # Returns a matrix of how many seconds each pair of browsers ran at
+    # the same time for the same user, with the total running time of
+    # each browser on the diagonal.
+    def overlap(self):
+        count = len(journal.BROWSERS)
+        matrix = numpy.zeros((count, count))
+        for user in numpy.unique(self.user):
+            mine = self.user == user
+            browser = self.browser[mine]
+            # Every start and end is a step of +1 or -1 in the number of
+            # sessions of its browser. Summing the steps in time order
+            # gives which browsers run between two consecutive steps.
+            times = numpy.concatenate((self.start[mine], self.end[mine]))
+            steps = numpy.zeros((len(times), count))
+            rows = numpy.arange(len(browser))
+            steps[rows, browser] = 1
+            steps[rows + len(browser), browser] = -1
+            order = numpy.argsort(times, kind='stable')
+            active = numpy.cumsum(steps[order], axis=0)[:-1] > 0
+            lengths = numpy.diff(times[order])
+            matrix += (active * lengths[:, None]).T @ active
+        return matrix
+
+    # Returns how long at least two browsers were running at once, added
+    # up over all users.
+    def concurrent_time(self):
+        total = 0.0
+        for user in numpy.unique(self.user):
+            mine = self.user == user
+            times = numpy.concatenate((self.start[mine], self.end[mine]))
+            steps = numpy.concatenate((numpy.ones(numpy.count_nonzero(mine)),
+                                       -numpy.ones(numpy.count_nonzero(mine))))
+            order = numpy.argsort(times, kind='stable')
+            running = numpy.cumsum(steps[order])[:-1]
+            lengths = numpy.diff(times[order])
+            total += float(lengths[running >= 2].sum())
+        return total
+
+    def export(self, path):
+        latencies, already = self.switch_latencies()
+        numpy.savez_compressed(path, user=self.user, browser=self.browser,
+                               start=self.start, end=self.end,
+                               running=self.running, overlap=self.overlap(),
+                               switch_latency=latencies,
+                               switch_already_running=already,
+                               browsers=numpy.array(journal.BROWSERS))
+
+# Returns the sessions found in the records of a journal. A session runs
+# from a 'running' record to the next 'off' record of the same browser
+# and user. A browser still running at the end of the journal is taken
+# to run until the given time, or until the last record if none is
+# given. A 'running' record that is followed by another one, which is
+# what the journal shows when the monitor was stopped in between, has no
+# known end and is left out.
+def sessions_from_records(records, until=None):
+    selected = (records['event'] == journal.RUNNING) | (
+        records['event'] == journal.OFF)
+    records = records[selected]
+    if until is None:
+        until = float(records['time'].max()) if len(records) else 0.0
+    key = (records['user'].astype(numpy.int64) << 8) | records['browser']
+    order = numpy.argsort(key, kind='stable')
+    key = key[order]
+    event = records['event'][order]
+    when = records['time'][order]
+    same = key[:-1] == key[1:]
+    finished = same & (event[:-1] == journal.RUNNING) & (
+        event[1:] == journal.OFF)
+    last = numpy.append(~same, True)
+    running = last & (event == journal.RUNNING)
+    starts = numpy.concatenate((numpy.flatnonzero(finished),
+                                numpy.flatnonzero(running)))
+    ends = numpy.concatenate((when[numpy.flatnonzero(finished) + 1],
+                              numpy.full(numpy.count_nonzero(running),
+                                         until)))
+    return SessionTable(
+        (key[starts] >> 8).astype(numpy.uint32),
+        (key[starts] & 0xff).astype(numpy.uint8),
+        when[starts], ends,
+        numpy.concatenate((numpy.zeros(numpy.count_nonzero(finished),
+                                       dtype=bool),
+                           numpy.ones(numpy.count_nonzero(running),
+                                      dtype=bool))))
+
+def print_report(sessions):
+    print("%d sessions" % len(sessions))
+    for name, stats in sessions.duration_summary().items():
+        print("%-8s %5d sessions, mean %8.0fs, median %8.0fs, "
+              "p90 %8.0fs, total %9.0fs" % (name, stats['sessions'],
+              stats['mean'], stats['median'], stats['p90'], stats['total']))
+    latencies, already = sessions.switch_latencies()
+    if len(latencies):
+        switched = latencies[~numpy.isnan(latencies)]
+        print("Tor Browser closed %d times: another browser was already "
+              "running %d times, one was started afterwards %d times"
+              % (len(latencies), numpy.count_nonzero(already),
+                 len(switched)))
+        if len(switched):
+            print("Time to the next browser: median %.0fs, p90 %.0fs"
+                  % (numpy.median(switched),
+                     numpy.percentile(switched, 90)))
+    print("Browsers ran concurrently for %.0fs" % sessions.concurrent_time())
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Browsing session analytics over a journal.")
+    parser.add_argument('journal', help="The journal file to read.")
+    parser.add_argument('--until', type=float, default=None,
+            help="When sessions still running end, as a Unix time. "
+                 "Defaults to now.")
+    parser.add_argument('--export', help="Write the sessions and results "
+                        "to this compressed .npz file.")
+    args = parser.parse_args()
+    until = args.until if args.until is not None else time.time()
+    sessions = sessions_from_records(journal.read_journal(args.journal),
+                                     until)
+    print_report(sessions)
+    if args.export:
+        sessions.export(args.export)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,802 @@
+#!/usr/bin/env python3
+"""
+File: bench_scan.py
+
+Description:
+Benchmarks for the process scanners of process_monitor.py. The
+scanners are driven against a synthetic process table that stands in
+for psutil.process_iter, so that the cost of a scan can be measured for
+tables of any size and mix of browsers, and compared between versions.
+The table can contain Chrome style swarms of --type children and
+processes that disappear while they are being read.
+
+For every table size and scanner we report scans per second, the median
+and 99th percentile scan latency, the memory allocated during a scan as
+traced by tracemalloc, and the delay between a browser launching and
+the scanner reporting it. With --live, the scanners are also run
+against the real process table, which is the only way to measure the
+/proc scanner. The results are written as JSON with --output.
+
+With --crossover, the serial and the parallel scan are timed on cold
+scans, where every process is new, for each table size, and the
+smallest size at which the threads win is reported. Reading a process
+costs no more than a system call on the synthetic tables, unless
+--read-latency makes every read block for a while, as reads of /proc do
+on a busy machine.
+
+With --check-memory, the scanners instead run a few hundred scans
+against each table while tracemalloc watches process_monitor.py, and
+the benchmark fails unless the memory they keep and the peak of a scan
+stay flat from the middle of the run to its end.
+
+With --check-state, nothing is timed; instead the results are checked.
+BrowserState is driven with random scans next to a plain reference
+that keeps a flag per browser, and the two have to agree on every
+journal record, trigger and survey. The scanners run against tables
+that change from scan to scan, with browsers launching, closing and
+appearing through exec, and the cached serial scan, the parallel scan
+and an uncached scan have to find the same browsers after every scan.
+With --live the /proc scanner also has to agree with psutil on the
+real process table.
+
+Example:
+    python3 bench_scan.py --processes 100 1000 20000 --output bench.json
+    python3 bench_scan.py --check-memory --processes 5000
+    python3 bench_scan.py --check-state --processes 1000 --live
+    python3 bench_scan.py --crossover --threads 8 --read-latency 50 --live
+"""
+import argparse
+import collections
+import contextlib
+import getpass
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import psutil
+
+import process_monitor
+
+# Names for the processes that are not browsers.
+OTHER_NAMES = ('systemd', 'bash', 'sshd', 'kworker/0:1', 'Xorg', 'cron',
+               'pulseaudio', 'python3', 'gnome-shell', 'dbus-daemon',
+               'node', 'java', 'make', 'gcc', 'cc1', 'ld', 'git', 'vim',
+               'svchost.exe', 'explorer.exe', 'RuntimeBroker.exe')
+
+# The scanners that can be driven against a synthetic table, with the
+# platform whose default rules they use.
+SCANNERS = {
+    'linux': (process_monitor.ul_process_check, 'linux'),
+    'windows': (process_monitor.windows_process_check, 'win32'),
+}
+
+UIDS = collections.namedtuple('UIDS', 'real effective saved')
+
+# Scans run before memory is checked, so that the cache and the
+# interpreter have reached their steady state.
+MEMORY_WARMUP_SCANS = 20
+
+# How long, in seconds, every read from a synthetic process blocks.
+read_latency = 0.0
+
+# This class imitates the parts of psutil.Process the scanners use. A
+# process marked as vanishing raises NoSuchProcess as soon as anything
+# is read from it, like a process that exits during a scan.
+class FakeProcess:
+    def __init__(self, pid, ppid, name, cmdline, environ, vanish=False):
+        self.pid = pid
+        self._ppid = ppid
+        self._name = name
+        self._cmdline = cmdline
+        self._environ = environ
+        self._create_time = time.time()
+        self.vanish = vanish
+        self.browser = None
+
+    def _check(self):
+        if read_latency:
+            time.sleep(read_latency)
+        if self.vanish:
+            raise psutil.NoSuchProcess(self.pid)
+
+    def create_time(self):
+        return self._create_time
+
+    def name(self):
+        self._check()
+        return self._name
+
+    def cmdline(self):
+        self._check()
+        return self._cmdline
+
+    def environ(self):
+        self._check()
+        return self._environ
+
+    def ppid(self):
+        self._check()
+        return self._ppid
+
+    # Every synthetic process belongs to the user running the benchmark.
+    def uids(self):
+        self._check()
+        return UIDS(os.getuid(), os.geteuid(), os.getuid())
+
+    def username(self):
+        self._check()
+        return getpass.getuser()
+
+# Returns the processes a browser starts on a platform, as a list of
+# (name, cmdline, environ) tuples. The first one is the root process,
+# the others are its children.
+def browser_tree(browser, system, children):
+    exe = '.exe' if system == 'win32' else ''
+    if browser == 'firefox':
+        root = ('firefox' + exe, ['/usr/lib/firefox/firefox'], {})
+        child = ('firefox' + exe if exe else 'Web Content',
+                 ['/usr/lib/firefox/firefox', '-contentproc', '7'], {})
+    elif browser == 'tor':
+        path = '/home/user/Tor Browser/Browser/firefox'
+        if system == 'darwin':
+            path = '/Applications/TorBrowser.app/Contents/MacOS/firefox'
+        environ = {}
+        if system == 'win32':
+            environ = {'TOR_BROWSER_TOR_DATA_DIR': 'C:\\Tor Browser\\Data'}
+        root = ('firefox' + exe, [path], environ)
+        child = ('firefox' + exe, [path, '-contentproc', '7'], environ)
+    elif browser == 'chrome':
+        root = ('chrome' + exe, ['/opt/google/chrome/chrome'], {})
+        child = ('chrome' + exe,
+                 ['/opt/google/chrome/chrome', '--type=renderer'], {})
+    elif browser == 'opera':
+        root = ('opera' + exe, ['/usr/lib/opera/opera'], {})
+        child = ('opera' + exe, ['/usr/lib/opera/opera', '--type=gpu'], {})
+    else:
+        raise Exception("No synthetic processes for %s" % browser)
+    return [root] + [child] * children
+
+# This class holds a synthetic process table and serves it through the
+# same functions psutil offers. Pids only ever grow, so the table is
+# always in pid order, like the real process_iter.
+class SyntheticTable:
+    def __init__(self, size, system, mix, children, churn, vanish, seed):
+        self.random = random.Random(seed)
+        self.system = system
+        self.children = children
+        self.churn = churn
+        self.vanish = vanish
+        self.procs = {}
+        self.next_pid = 300
+        self.pending = None
+        self.launched = None
+        for browser in mix:
+            self.launch(browser)
+        while len(self.procs) < size:
+            self.add_other()
+
+    def add(self, ppid, name, cmdline, environ, vanish=False):
+        proc = FakeProcess(self.next_pid, ppid, name, cmdline, environ,
+                           vanish)
+        self.procs[proc.pid] = proc
+        self.next_pid += 1
+        return proc
+
+    def add_other(self):
+        name = self.random.choice(OTHER_NAMES)
+        vanish = self.random.random() < self.vanish
+        return self.add(1, name, [name, '--option'], {}, vanish)
+
+    def launch(self, browser):
+        tree = browser_tree(browser, self.system, self.children)
+        root = None
+        for name, cmdline, environ in tree:
+            proc = self.add(root.pid if root else 1, name, cmdline, environ)
+            proc.browser = browser
+            if root is None:
+                root = proc
+        self.launched = time.perf_counter()
+
+    def close(self, browser):
+        for pid, proc in list(self.procs.items()):
+            if proc.browser == browser:
+                del self.procs[pid]
+
+    # Turns a process that is not a browser into the root of one, as
+    # exec does: the pid and the create time stay the same.
+    def exec_into(self, browser):
+        others = [proc for proc in self.procs.values()
+                  if proc.browser is None and not proc.vanish]
+        proc = self.random.choice(others)
+        proc._name, proc._cmdline, proc._environ = browser_tree(
+                browser, self.system, 0)[0]
+        proc.browser = browser
+
+    # Launches a browser once the next scan has visited this many
+    # processes, so the launch can land anywhere in a scan.
+    def launch_during_scan(self, browser, position):
+        self.pending = (position, browser)
+
+    # Replaces the processes that vanished, and a share of the others,
+    # with new ones, as happens between two scans on a busy machine.
+    def tick(self):
+        others = [pid for pid, proc in self.procs.items()
+                  if proc.browser is None]
+        replaced = [pid for pid in others if self.procs[pid].vanish]
+        replaced += self.random.sample(others,
+                                       int(len(others) * self.churn))
+        for pid in replaced:
+            if self.procs.pop(pid, None) is not None:
+                self.add_other()
+
+    def process_iter(self, attrs=None, ad_value=None):
+        for position, proc in enumerate(list(self.procs.values())):
+            if self.pending is not None and position == self.pending[0]:
+                browser = self.pending[1]
+                self.pending = None
+                self.launch(browser)
+            yield proc
+
+    def Process(self, pid):
+        proc = self.procs.get(pid)
+        if proc is None:
+            raise psutil.NoSuchProcess(pid)
+        return proc
+
+# Swaps psutil's process table for a synthetic one while the scanners
+# run.
+class synthetic_psutil:
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        self.saved = (psutil.process_iter, psutil.Process)
+        psutil.process_iter = self.table.process_iter
+        psutil.Process = self.table.Process
+
+    def __exit__(self, *exc):
+        psutil.process_iter, psutil.Process = self.saved
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+# Gives every measurement a cache of its own.
+def fresh_cache():
+    process_monitor.process_cache = process_monitor.ProcessCache()
+    process_monitor.scan_counters.reset()
+
+# Times a number of scans, with the table changing between them as
+# configured. The first scan runs against an empty cache.
+def time_scans(check, matcher, table, scans):
+    fresh_cache()
+    browsers = process_monitor.BrowserState()
+    start = time.perf_counter()
+    check(browsers, matcher)
+    cold = time.perf_counter() - start
+    latencies = []
+    for i in range(scans):
+        table.tick()
+        start = time.perf_counter()
+        check(browsers, matcher)
+        latencies.append(time.perf_counter() - start)
+    return cold, latencies
+
+# Measures the memory allocated during a scan. tracemalloc does not
+# count allocations, so we record how far the traced memory rose above
+# where it started (the scan's peak), and how much of it the scan kept.
+def trace_scans(check, matcher, table, scans):
+    fresh_cache()
+    browsers = process_monitor.BrowserState()
+    check(browsers, matcher)
+    peaks = []
+    kept = []
+    tracemalloc.start()
+    try:
+        for i in range(scans):
+            table.tick()
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            check(browsers, matcher)
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            kept.append(current - before)
+    finally:
+        tracemalloc.stop()
+    return peaks, kept
+
+# Checks that a long run of scans keeps no memory. After a warm up, the
+# memory allocated from process_monitor.py, and the number of blocks
+# holding it, are compared between the middle and the end of the run;
+# the process table changes as on a busy machine throughout, so the
+# cache is kept busy evicting and classifying. Returns how many bytes
+# and blocks each scan kept on average, and the median peak of a scan
+# in both halves.
+def check_memory(check, matcher, table, scans):
+    monitor = [tracemalloc.Filter(True, process_monitor.__file__)]
+    peaks = []
+    # Tracing starts before the cache is filled, otherwise the records
+    # it evicts later would be freed without having been counted.
+    tracemalloc.start()
+    try:
+        fresh_cache()
+        browsers = process_monitor.BrowserState()
+        for i in range(MEMORY_WARMUP_SCANS):
+            table.tick()
+            check(browsers, matcher)
+        for i in range(scans):
+            if i == scans // 2:
+                middle = tracemalloc.take_snapshot().filter_traces(monitor)
+            table.tick()
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            check(browsers, matcher)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        end = tracemalloc.take_snapshot().filter_traces(monitor)
+    finally:
+        tracemalloc.stop()
+    kept = end.compare_to(middle, 'filename')
+    scanned = scans - scans // 2
+    return (sum(stat.size_diff for stat in kept) / scanned,
+            sum(stat.count_diff for stat in kept) / scanned,
+            percentile(peaks[:scans // 2], 0.50),
+            percentile(peaks[scans // 2:], 0.50))
+
+# Measures how long it takes from a browser launching, at a random point
+# during a scan, until a scanner running back to back reports it.
+def detection_latency(check, matcher, table, browser, trials):
+    fresh_cache()
+    browsers = process_monitor.BrowserState()
+    latencies = []
+    for i in range(trials):
+        table.close(browser)
+        check(browsers, matcher)
+        table.launch_during_scan(browser,
+                                 table.random.randrange(len(table.procs)))
+        while True:
+            check(browsers, matcher)
+            if browsers.is_running(browser):
+                latencies.append(time.perf_counter() - table.launched)
+                break
+    return latencies
+
+def bench_synthetic(args, size, scanner):
+    check, system = SCANNERS[scanner]
+    matcher = process_monitor.BrowserMatcher(
+            process_monitor.default_variables(system))
+    table = SyntheticTable(size, system, args.mix, args.children,
+                           args.churn, args.vanish, args.seed)
+    with synthetic_psutil(table):
+        cold, latencies = time_scans(check, matcher, table, args.scans)
+        peaks, kept = trace_scans(check, matcher, table, args.traced_scans)
+        detection = detection_latency(check, matcher, table, args.launch,
+                                      args.launch_trials)
+    return {'table': 'synthetic',
+            'scanner': scanner,
+            'processes': size,
+            'cold_scan_ms': cold * 1000,
+            'scans_per_second': len(latencies) / sum(latencies),
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'allocated_bytes_per_scan': percentile(peaks, 0.50),
+            'kept_bytes_per_scan': percentile(kept, 0.50),
+            'detection_p50_ms': percentile(detection, 0.50) * 1000,
+            'detection_p99_ms': percentile(detection, 0.99) * 1000}
+
+# Runs the memory check for a table size and scanner, and returns
+# whether memory stayed flat.
+def memory_result(args, size, scanner):
+    check, system = SCANNERS[scanner]
+    matcher = process_monitor.BrowserMatcher(
+            process_monitor.default_variables(system))
+    table = SyntheticTable(size, system, args.mix, args.children,
+                           args.churn, args.vanish, args.seed)
+    with synthetic_psutil(table):
+        kept_bytes, kept_blocks, first_peak, last_peak = check_memory(
+                check, matcher, table, args.memory_scans)
+    flat = (kept_bytes <= args.memory_tolerance
+            and kept_blocks <= args.memory_tolerance / 64
+            and last_peak <= first_peak * 1.25 + args.memory_tolerance)
+    print("memory    %-8s %6d processes: kept %7.1f bytes and %5.2f blocks "
+          "per scan, peak %d then %d bytes: %s" % (scanner, size,
+          kept_bytes, kept_blocks, first_peak, last_peak,
+          "flat" if flat else "GROWING"))
+    return {'table': 'memory',
+            'scanner': scanner,
+            'processes': size,
+            'kept_bytes_per_scan': kept_bytes,
+            'kept_blocks_per_scan': kept_blocks,
+            'first_peak_bytes': first_peak,
+            'last_peak_bytes': last_peak,
+            'flat': flat}
+
+# This class is the reference for BrowserState: a flag for each browser
+# and one for each survey trigger, set and cleared one browser at a time
+# the plain way. It records journal records as (browser, event, flags).
+class ReferenceState:
+    def __init__(self):
+        self.running = dict((name, False)
+                            for name in process_monitor.BROWSERS)
+        self.instances = dict((name, 0) for name in process_monitor.BROWSERS)
+        self.trigger_survey = False
+        self.trigger_tor_survey = False
+        self.records = []
+
+    def flags(self):
+        flags = 0
+        if self.trigger_survey:
+            flags |= process_monitor.journal.TRIGGER_SURVEY
+        if self.trigger_tor_survey:
+            flags |= process_monitor.journal.TRIGGER_TOR_SURVEY
+        return flags
+
+    def update(self, running):
+        journal = process_monitor.journal
+        for index, name in enumerate(process_monitor.BROWSERS):
+            instances = running.get(name, (0, 0))[0]
+            before = self.instances[name]
+            self.instances[name] = instances
+            if before and instances and instances != before:
+                event = journal.OPENED if instances > before else journal.CLOSED
+                self.records.append((index, event, self.flags()))
+            now = name in running
+            if self.running[name] and not now:
+                if name == 'tor':
+                    self.trigger_tor_survey = True
+                else:
+                    self.trigger_survey = True
+            changed = now != self.running[name]
+            self.running[name] = now
+            if changed:
+                self.records.append((index, int(now), self.flags()))
+
+    def triggered_survey(self):
+        if self.trigger_survey and not self.running['tor']:
+            self.trigger_survey = False
+            return process_monitor.NONTOR
+        if self.trigger_survey:
+            self.trigger_survey = False
+            self.trigger_tor_survey = False
+            return process_monitor.SWITCHED
+        if self.trigger_tor_survey:
+            self.trigger_tor_survey = False
+            return process_monitor.TOR
+        return None
+
+# Drives BrowserState and the reference with the same random scans, and
+# returns the sequences on which they disagreed.
+def check_transitions(trials, steps, seed):
+    rng = random.Random(seed)
+    records = []
+    saved = process_monitor.record_transition
+    process_monitor.record_transition = (
+            lambda browser, event, flags, user:
+                records.append((browser, event, flags)))
+    mismatches = []
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for trial in range(trials):
+                state = process_monitor.BrowserState()
+                reference = ReferenceState()
+                del records[:]
+                for step in range(steps):
+                    running = {}
+                    for name in process_monitor.BROWSERS:
+                        if rng.random() < 0.4:
+                            running[name] = (rng.randint(1, 3),
+                                             rng.randint(0, 4))
+                    process_monitor.update_browser_state(state, running)
+                    reference.update(running)
+                    same = (records == reference.records
+                            and state.trigger_flags() == reference.flags()
+                            and all(state.is_running(name)
+                                    == reference.running[name]
+                                    for name in process_monitor.BROWSERS))
+                    if same and rng.random() < 0.5:
+                        same = (state.triggered_survey()
+                                == reference.triggered_survey())
+                    if not same:
+                        mismatches.append((trial, step, running))
+                        break
+    finally:
+        process_monitor.record_transition = saved
+    print("state     %d random sequences of %d scans: %s" % (trials, steps,
+          "%d mismatches" % len(mismatches) if mismatches else "agree"))
+    return mismatches
+
+# Runs a scan against a cache of its own and returns the browsers it
+# found, for every user. With quiet, the scan is an event step that had
+# no process events to report.
+def scan_with(cache, matcher, quiet=False):
+    process_monitor.process_cache = cache
+    if quiet:
+        process_monitor.update_processes(matcher, (), ())
+    else:
+        process_monitor.scan_processes(matcher)
+    return dict((user, dict(running)) for user, running
+                in cache.running_by_user().items())
+
+# Scans a changing synthetic table with the cached serial scan, the
+# parallel scan and an uncached scan, and returns the scans after which
+# they disagreed. Now and then the configuration is reloaded, and the
+# serial cache then only sees an event step with nothing to report.
+def check_scans(args, size, scanner, pool):
+    check, system = SCANNERS[scanner]
+    variables = process_monitor.default_variables(system)
+    matcher = process_monitor.BrowserMatcher(variables)
+    table = SyntheticTable(size, system, args.mix, args.children,
+                           args.churn, args.vanish, args.seed)
+    browsers = list(args.mix) + ['tor']
+    serial = process_monitor.ProcessCache()
+    parallel = process_monitor.ProcessCache()
+    mismatches = []
+    with synthetic_psutil(table):
+        for step in range(args.scans):
+            table.tick()
+            event = table.random.random()
+            browser = table.random.choice(browsers)
+            reload = event < 0.1
+            if reload:
+                matcher = process_monitor.BrowserMatcher(variables)
+            elif event < 0.25:
+                table.exec_into(browser)
+            elif event < 0.4:
+                table.launch(browser)
+            elif event < 0.55:
+                table.close(browser)
+            process_monitor.scan_pool = None
+            found = scan_with(serial, matcher, reload)
+            expected = scan_with(process_monitor.ProcessCache(), matcher)
+            process_monitor.scan_pool = pool
+            found_parallel = scan_with(parallel, matcher)
+            process_monitor.scan_pool = None
+            if not found == found_parallel == expected:
+                mismatches.append((step, expected, found, found_parallel))
+    print("scans     %-8s %6d processes, %d scans: %s" % (scanner, size,
+          args.scans, "%d mismatches" % len(mismatches)
+          if mismatches else "agree"))
+    return mismatches
+
+# Compares the /proc scanner with psutil on the real process table. A
+# difference only counts if two psutil scans around the /proc scan
+# agree, so that processes starting or exiting meanwhile are not blamed.
+def check_live(tries=5):
+    variables = process_monitor.default_variables(sys.platform)
+    psutil_matcher = process_monitor.scanner_matcher(variables, 'psutil')
+    procfs_matcher = process_monitor.scanner_matcher(variables, 'procfs')
+    for i in range(tries):
+        before = scan_with(process_monitor.ProcessCache(), psutil_matcher)
+        found = scan_with(process_monitor.ProcessCache(), procfs_matcher)
+        after = scan_with(process_monitor.ProcessCache(), psutil_matcher)
+        if before != after:
+            continue
+        agree = found == before
+        print("live      procfs and psutil: %s" % (
+              "agree" if agree else "disagree, %s against %s"
+              % (found, before)))
+        return [] if agree else [(found, before)]
+    print("live      the process table kept changing, not compared")
+    return []
+
+# Runs a scanner against the real process table of this machine.
+def bench_live(args, scanner):
+    check = process_monitor.ul_process_check
+    matcher = process_monitor.scanner_matcher(
+            process_monitor.default_variables(sys.platform), scanner)
+    browsers = process_monitor.BrowserState()
+    colds = []
+    latencies = []
+    for i in range(args.scans):
+        fresh_cache()
+        start = time.perf_counter()
+        check(browsers, matcher)
+        colds.append(time.perf_counter() - start)
+    for i in range(args.scans):
+        start = time.perf_counter()
+        check(browsers, matcher)
+        latencies.append(time.perf_counter() - start)
+    return {'table': 'live',
+            'scanner': scanner,
+            'processes': len(process_monitor.process_cache.entries),
+            'cold_scan_ms': percentile(colds, 0.50) * 1000,
+            'scans_per_second': len(latencies) / sum(latencies),
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000}
+
+# Returns the median time of a cold scan, with the thread pool of the
+# parallel scan or without it.
+def cold_scans(check, matcher, runs, pool):
+    process_monitor.scan_pool = pool
+    browsers = process_monitor.BrowserState()
+    times = []
+    try:
+        for i in range(runs):
+            fresh_cache()
+            start = time.perf_counter()
+            check(browsers, matcher)
+            times.append(time.perf_counter() - start)
+    finally:
+        process_monitor.scan_pool = None
+    return percentile(times, 0.50)
+
+def crossover_result(table, scanner, size, serial, parallel, threads):
+    print("%-9s %-8s %6d processes: serial %8.2fms, %d threads %8.2fms, "
+          "%.2fx" % (table, scanner, size, serial * 1000, threads,
+          parallel * 1000, serial / parallel))
+    return {'table': table,
+            'scanner': scanner,
+            'processes': size,
+            'threads': threads,
+            'serial_ms': serial * 1000,
+            'parallel_ms': parallel * 1000,
+            'speedup': serial / parallel}
+
+# Times cold scans serially and in parallel for every table size, and
+# returns the results with the crossover of each scanner: the smallest
+# size from which the parallel scan was faster at every size, or None.
+def crossover(args):
+    global read_latency
+    read_latency = args.read_latency / 1e6
+    process_monitor.start_scan_pool(args.threads, 0)
+    pool = process_monitor.scan_pool
+    results = []
+    crossovers = {}
+    for scanner in args.scanners:
+        check, system = SCANNERS[scanner]
+        matcher = process_monitor.BrowserMatcher(
+                process_monitor.default_variables(system))
+        crossovers[scanner] = None
+        for size in sorted(args.processes, reverse=True):
+            table = SyntheticTable(size, system, args.mix, args.children,
+                                   0, 0, args.seed)
+            with synthetic_psutil(table):
+                serial = cold_scans(check, matcher, args.crossover_runs,
+                                    None)
+                parallel = cold_scans(check, matcher, args.crossover_runs,
+                                      pool)
+            results.append(crossover_result('synthetic', scanner, size,
+                                            serial, parallel, args.threads))
+            if parallel >= serial:
+                break
+            crossovers[scanner] = size
+    read_latency = 0.0
+    if args.live:
+        live = ['psutil']
+        if sys.platform == 'linux':
+            live.append('procfs')
+        for scanner in live:
+            matcher = process_monitor.scanner_matcher(
+                    process_monitor.default_variables(sys.platform), scanner)
+            check = process_monitor.ul_process_check
+            serial = cold_scans(check, matcher, args.crossover_runs, None)
+            parallel = cold_scans(check, matcher, args.crossover_runs, pool)
+            results.append(crossover_result('live', scanner,
+                    len(process_monitor.process_cache.entries), serial,
+                    parallel, args.threads))
+    for scanner, size in sorted(crossovers.items()):
+        if size is None:
+            print("%s: the parallel scan never paid off" % scanner)
+        else:
+            print("%s: the parallel scan pays off from %d processes"
+                  % (scanner, size))
+    return results, crossovers
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_result(result):
+    line = "%(table)-9s %(scanner)-8s %(processes)6d processes: " \
+           "%(scans_per_second)8.1f scans/s, p50 %(p50_ms)7.2fms, " \
+           "p99 %(p99_ms)7.2fms, cold %(cold_scan_ms)7.2fms" % result
+    if 'detection_p50_ms' in result:
+        line += (", %(allocated_bytes_per_scan)d bytes/scan, "
+                 "detected in %(detection_p50_ms).2fms" % result)
+    print(line)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--processes', type=int, nargs='+',
+                        default=[100, 1000, 5000, 20000],
+                        help="sizes of the synthetic process tables")
+    parser.add_argument('--scanners', nargs='+', default=sorted(SCANNERS),
+                        choices=sorted(SCANNERS))
+    parser.add_argument('--mix', nargs='*', default=['firefox', 'chrome'],
+                        help="browsers running in the synthetic tables")
+    parser.add_argument('--children', type=int, default=30,
+                        help="child processes started by each browser")
+    parser.add_argument('--churn', type=float, default=0.01,
+                        help="share of processes replaced between scans")
+    parser.add_argument('--vanish', type=float, default=0.001,
+                        help="share of processes that exit mid-scan")
+    parser.add_argument('--launch', default='tor',
+                        help="browser launched to measure detection")
+    parser.add_argument('--launch-trials', type=int, default=20)
+    parser.add_argument('--scans', type=int, default=50)
+    parser.add_argument('--traced-scans', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--live', action='store_true',
+                        help="also scan the real process table")
+    parser.add_argument('--check-memory', action='store_true',
+                        help="only check that memory stays flat over many "
+                             "scans, and fail if it does not")
+    parser.add_argument('--memory-scans', type=int, default=200)
+    parser.add_argument('--memory-tolerance', type=float, default=256,
+                        help="bytes each scan may keep on average")
+    parser.add_argument('--check-state', action='store_true',
+                        help="only check that BrowserState and the scans "
+                             "give the expected results, and fail if not")
+    parser.add_argument('--state-trials', type=int, default=2000)
+    parser.add_argument('--crossover', action='store_true',
+                        help="only compare the serial and the parallel "
+                             "scan")
+    parser.add_argument('--threads', type=int, default=4,
+                        help="threads of the parallel scan")
+    parser.add_argument('--read-latency', type=float, default=0,
+                        help="microseconds every synthetic read blocks")
+    parser.add_argument('--crossover-runs', type=int, default=5)
+    parser.add_argument('--output', help="write the results as JSON here")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    results = []
+    if args.crossover:
+        results, crossovers = crossover(args)
+        write_report(args, results + [{'crossover': crossovers}])
+        return
+    if args.check_state:
+        failed = bool(check_transitions(args.state_trials, 30, args.seed))
+        process_monitor.start_scan_pool(args.threads, 0)
+        pool = process_monitor.scan_pool
+        for size in args.processes:
+            for scanner in args.scanners:
+                failed |= bool(check_scans(args, size, scanner, pool))
+        if args.live and sys.platform == 'linux':
+            failed |= bool(check_live())
+        if failed:
+            sys.exit(1)
+        return
+    if args.check_memory:
+        for size in args.processes:
+            for scanner in args.scanners:
+                results.append(memory_result(args, size, scanner))
+        write_report(args, results)
+        if not all(result['flat'] for result in results):
+            sys.exit(1)
+        return
+    for size in args.processes:
+        for scanner in args.scanners:
+            results.append(bench_synthetic(args, size, scanner))
+            print_result(results[-1])
+    if args.live:
+        live = ['psutil']
+        if sys.platform == 'linux':
+            live.append('procfs')
+        for scanner in live:
+            results.append(bench_live(args, scanner))
+            print_result(results[-1])
+    write_report(args, results)
+
+def write_report(args, results):
+    if args.output:
+        report = {'version': git_version(),
+                  'python': sys.version.split()[0],
+                  'platform': sys.platform,
+                  'time': time.time(),
+                  'parameters': vars(args),
+                  'results': results}
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+if __name__ == "__main__":
+    main()
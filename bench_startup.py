@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+File: bench_startup.py
+
+Description:
+Benchmarks how quickly process_monitor.py starts. The monitor is
+launched at every login, and other tools import it, so importing it
+has to stay cheap and free of side effects. Every measurement runs in
+a fresh interpreter, with HOME pointing to an empty directory so that
+no real configuration is read or written.
+
+We report the median wall time of an interpreter that does nothing, of
+one that imports process_monitor, and of one that goes as far as the
+first scan: importing, selecting the platform, creating and loading
+the configuration and scanning the process table once. The modules
+that importing loads are listed from -X importtime, heaviest first, and
+the heavy modules that should only load on demand are checked. The
+results are written as JSON with --output.
+
+Example:
+    python3 bench_startup.py --runs 20 --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_scan import git_version
+
+# The modules importing process_monitor should not load.
+LAZY_MODULES = ('psutil', 'asyncio', 'concurrent.futures', 'http.server',
+                'http.client', 'outbox', 'Quartz', 'proc_events',
+                'subprocess', 'webbrowser')
+
+IMPORT = "import process_monitor"
+
+FIRST_SCAN = """
+import process_monitor
+process_monitor.select_platform()
+config = process_monitor.load_config()
+process_monitor.process_scan(config.matcher)
+"""
+
+LOADED = """
+import importlib.util, sys
+import process_monitor
+loaded = [name for name in %r if name in sys.modules
+          and not isinstance(sys.modules[name], importlib.util._LazyModule)]
+print(' '.join(loaded))
+""" % (LAZY_MODULES,)
+
+def run(code, home, extra=()):
+    environment = dict(os.environ, HOME=home, PYTHONDONTWRITEBYTECODE='1')
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + list(extra) + ['-c', code],
+                            env=environment, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise Exception("Benchmark run failed:\n%s" % result.stderr)
+    return seconds, result
+
+# Returns the median wall time of running the code in a fresh
+# interpreter. Every run gets an empty home directory, except when the
+# configuration should already exist.
+def time_runs(code, runs, home=None):
+    times = []
+    for i in range(runs):
+        with tempfile.TemporaryDirectory() as fresh:
+            times.append(run(code, home or fresh)[0])
+    return statistics.median(times)
+
+# Returns the modules that importing process_monitor loads, with the
+# cumulative microseconds each took, heaviest first.
+def import_profile(home):
+    result = run(IMPORT, home, ['-X', 'importtime'])[1]
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(cumulative)))
+    modules.sort(key=lambda module: -module[1])
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10,
+                        help="how many of the heaviest imports to list")
+    parser.add_argument('--output', help="write the results as JSON here")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        baseline = time_runs("pass", args.runs)
+        imported = time_runs(IMPORT, args.runs)
+        # The first run creates the configuration, the others read it.
+        first_scan_new = time_runs(FIRST_SCAN, 1, home)
+        first_scan = time_runs(FIRST_SCAN, args.runs, home)
+        created = os.listdir(home)
+        profile = import_profile(home)
+        loaded = run(LOADED, home)[1].stdout.split()
+
+    print("interpreter          %7.1fms" % (baseline * 1000))
+    print("import               %7.1fms (+%.1fms)"
+          % (imported * 1000, (imported - baseline) * 1000))
+    print("first scan           %7.1fms (+%.1fms), %.1fms when creating "
+          "the configuration" % (first_scan * 1000,
+          (first_scan - baseline) * 1000, first_scan_new * 1000))
+    print("heaviest imports:")
+    for name, cumulative in profile[:args.top]:
+        print("  %-30s %7.1fms" % (name, cumulative / 1000))
+    if loaded:
+        print("loaded on import, but should be lazy:", ' '.join(loaded))
+    if args.output:
+        report = {'version': git_version(),
+                  'python': sys.version.split()[0],
+                  'platform': sys.platform,
+                  'time': time.time(),
+                  'parameters': vars(args),
+                  'results': {'interpreter_ms': baseline * 1000,
+                              'import_ms': imported * 1000,
+                              'first_scan_ms': first_scan * 1000,
+                              'first_scan_new_config_ms':
+                                  first_scan_new * 1000,
+                              'imports': profile,
+                              'eagerly_loaded': loaded,
+                              'home_after_runs': created}}
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+if __name__ == "__main__":
+    main()
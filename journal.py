@@ -0,0 +1,190 @@
+"""
+File: journal.py
+
+Description:
+An append-only journal of browser state transitions, so that switching
+behaviour can be analysed after the fact. Every transition is a fixed
+width record packed with struct: when it happened, which browser (or
+which survey), what happened, the survey trigger flags right after it
+and the user it happened for. Records go into a ring buffer in a
+memory-mapped file of a fixed size, so the journal never grows however
+long the monitor runs; once it is full the oldest records are
+overwritten. Records are written in
+batches and the file is left to the page cache, it is never fsynced
+per event. The reader loads the file into NumPy arrays without copying.
+"""
+import errno
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b'TORJRNL1'
+VERSION = 2
+
+# The header holds the magic, the version, the size of a record, the
+# capacity in records and the number of records ever written. The next
+# record goes to slot written % capacity.
+HEADER = struct.Struct("<8sHHIQ")
+HEADER_SIZE = 64
+
+# time, browser, event, flags, padding, user.
+RECORD = struct.Struct("<dBBBxI")
+
+# The browser field is the index of the browser in BROWSERS. For the
+# survey events it holds the survey (NONTOR, SWITCHED or TOR of
+# BrowserState) instead of a browser.
+BROWSERS = ('tor', 'chrome', 'safari', 'firefox', 'opera', 'edge')
+
+# The events.
+OFF = 0
+RUNNING = 1
+TRIGGERED = 2
+DISPLAYED = 3
+OPENED = 4
+CLOSED = 5
+EVENTS = ('off', 'running', 'triggered', 'displayed', 'opened', 'closed')
+
+# The user field holds the uid of the user the transition happened
+# for, or a number derived from their name on windows.
+UNKNOWN_USER = 0xffffffff
+
+# The trigger flags.
+TRIGGER_SURVEY = 1
+TRIGGER_TOR_SURVEY = 2
+
+# How many records are kept in memory before they are written out. The
+# runtime also flushes on a timer, so a quiet journal is not left behind.
+BATCH_SIZE = 64
+
+# The NumPy layout of a record, see read_journal.
+DTYPE = [('time', '<f8'), ('browser', 'u1'), ('event', 'u1'),
+         ('flags', 'u1'), ('pad', 'V1'), ('user', '<u4')]
+
+# Gives a journal file all of its blocks before it is mapped. A page of a
+# sparse file only gets a block when it is first written through the
+# map, and on a full disk that write raises SIGBUS, which kills the
+# monitor without a word. Where posix_fallocate is missing or the file
+# system doesn't support it, the file is filled up with zeros instead.
+def allocate(journal, size):
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(journal.fileno(), 0, size)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    journal.seek(0, os.SEEK_END)
+    left = size - journal.tell()
+    while left > 0:
+        chunk = min(left, 1 << 20)
+        journal.write(bytes(chunk))
+        left -= chunk
+    journal.flush()
+
+# This class writes the journal. The file is created with room for
+# capacity records, allocated up front; an existing file with another
+# layout is moved aside to <path>.old rather than overwritten.
+class Journal:
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.batch = []
+        size = HEADER_SIZE + capacity * RECORD.size
+        if os.path.exists(path) and not self._compatible(path, size):
+            os.replace(path, path + '.old')
+        if not os.path.exists(path):
+            # Made aside, so that a disk too full for it leaves nothing.
+            with open(path + '.tmp', 'wb') as journal:
+                journal.write(HEADER.pack(MAGIC, VERSION, RECORD.size,
+                                          capacity, 0))
+                allocate(journal, size)
+            os.replace(path + '.tmp', path)
+        with open(path, 'r+b') as journal:
+            # A journal made sparse by an older version gets its blocks
+            # now.
+            allocate(journal, size)
+            self.map = mmap.mmap(journal.fileno(), size)
+        self.written = HEADER.unpack_from(self.map, 0)[4]
+
+    def _compatible(self, path, size):
+        if os.path.getsize(path) != size:
+            return False
+        with open(path, 'rb') as journal:
+            header = journal.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return False
+        magic, version, record_size, capacity, _ = HEADER.unpack(header)
+        return (magic == MAGIC and version == VERSION
+                and record_size == RECORD.size and capacity == self.capacity)
+
+    def record(self, browser, event, flags, user, when=None):
+        if when is None:
+            when = time.time()
+        self.batch.append((when, browser, event, flags, user))
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    # Copies the batch into the ring, then updates the count in the
+    # header, so a reader never sees a slot that is half written as
+    # counted.
+    def flush(self):
+        if not self.batch:
+            return
+        written = self.written
+        for when, browser, event, flags, user in self.batch:
+            offset = HEADER_SIZE + (written % self.capacity) * RECORD.size
+            RECORD.pack_into(self.map, offset, when, browser, event, flags,
+                             user)
+            written += 1
+        self.batch = []
+        self.written = written
+        struct.pack_into("<Q", self.map, HEADER.size - 8, written)
+
+    def close(self):
+        self.flush()
+        self.map.flush()
+        self.map.close()
+
+# Reads the header of a journal file, returning the capacity and the
+# number of records ever written.
+def read_header(data):
+    magic, version, record_size, capacity, written = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise Exception("Not a journal file!")
+    return capacity, written
+
+# Returns the records of a journal as NumPy structured arrays that are
+# views onto the mapped file, oldest first. There are two of them once
+# the ring has wrapped around, and one before that.
+def journal_segments(path):
+    import numpy
+    with open(path, 'rb') as journal:
+        data = mmap.mmap(journal.fileno(), 0, access=mmap.ACCESS_READ)
+    capacity, written = read_header(data)
+    records = numpy.frombuffer(data, dtype=DTYPE, count=capacity,
+                               offset=HEADER_SIZE)
+    if written <= capacity:
+        return [records[:written]]
+    head = written % capacity
+    return [records[head:], records[:head]]
+
+# Returns the records of a journal in a single array, oldest first. This
+# only copies when the ring has wrapped around.
+def read_journal(path):
+    segments = journal_segments(path)
+    if len(segments) == 1:
+        return segments[0]
+    import numpy
+    return numpy.concatenate(segments)
+
+if __name__ == "__main__":
+    records = read_journal(sys.argv[1])
+    for record in records:
+        print("%s %-9s %d flags=%d user=%d" % (
+            time.strftime("%Y-%m-%d %H:%M:%S",
+                          time.localtime(record['time'])),
+            EVENTS[record['event']], record['browser'], record['flags'],
+            record['user']))
+    print("%d records" % len(records))
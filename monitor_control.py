@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+File: monitor_control.py
+
+Description:
+Asks a running process_monitor.py what it knows, over its control
+socket. The monitor answers from the state it already holds: which
+browsers it found running for each user, when the last survey was shown
+and how long the cooldown has left, and how its scans have been going.
+Asking never makes it scan, so scripts and status bars can ask as often
+as they like.
+
+The socket is the one set in the CONTROL section of the configuration
+file, or the one given with --socket. The answer is printed as JSON.
+For the tor query, the exit status is also 0 when Tor Browser is
+running and 1 when it is not, for use in shell scripts.
+
+Example:
+    python3 monitor_control.py status
+    python3 monitor_control.py tor && echo "Tor Browser is running"
+"""
+import argparse
+import json
+import socket
+import sys
+
+import process_monitor
+
+# Sends one query to the control socket and returns the answer.
+def ask(path, query, timeout=5.0):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        client.sendall(query.encode() + b'\n')
+        reply = client.makefile('rb').readline()
+    finally:
+        client.close()
+    if not reply:
+        raise ConnectionError("The monitor closed the control socket "
+                              "without answering")
+    return json.loads(reply)
+
+# Returns the control socket of the configuration file, or None if it
+# is turned off.
+def configured_socket():
+    location = process_monitor.config_location()
+    config = process_monitor.read_config(location)
+    return process_monitor.control_path(config)
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Ask a running monitor about its state.")
+    parser.add_argument('query', nargs='?', default='status',
+                        choices=process_monitor.CONTROL_QUERIES)
+    parser.add_argument('--socket', help="the control socket, instead of "
+                        "the one in the configuration file")
+    parser.add_argument('--timeout', type=float, default=5.0,
+                        help="seconds to wait for the answer")
+    args = parser.parse_args()
+    try:
+        path = args.socket or configured_socket()
+    except Exception as e:
+        sys.exit("Can't read the configuration: %s" % e)
+    if path is None:
+        sys.exit("The control socket is turned off in the configuration.")
+    try:
+        answer = ask(path, args.query, args.timeout)
+    except (OSError, ValueError) as e:
+        sys.exit("Can't ask the monitor at %s: %s" % (path, e))
+    print(json.dumps(answer, indent=2, sort_keys=True))
+    if 'error' in answer:
+        sys.exit(2)
+    if args.query == 'tor':
+        sys.exit(0 if answer['running'] else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+File: outbox.py
+
+Description:
+A durable outbox of survey trigger events, and the sender that delivers
+them to a collection endpoint. The monitor appends an event to the
+outbox whenever a survey is triggered: which survey, when, for whom and
+which browsers were running. Every event is one JSON line, written and
+fsynced before the monitor carries on, so a crash or a reboot loses
+nothing. How far the outbox has been delivered is kept in <path>.sent.
+Once everything is delivered and the file has grown past COMPACT_SIZE
+it is emptied.
+
+The sender posts the events in batches, as {"events": [...]}, over one
+HTTP(S) connection that is kept alive from batch to batch. Any 2xx
+answer acknowledges the whole batch. Events carry an id, so an endpoint
+that sees a batch twice after a lost answer can tell.
+
+Run on its own, this file is a stand-in collection endpoint that prints
+what it receives, and can be told to fail some of the requests, for
+trying the monitor out against.
+
+Example:
+    python3 outbox.py --port 8080 --fail 0.2
+"""
+import argparse
+import errno
+import http.client
+import http.server
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+
+# An outbox with nothing left to deliver is emptied once it is this big.
+COMPACT_SIZE = 1 << 20
+
+# Returns a new trigger event.
+def trigger_event(survey, user, running, when=None):
+    return {'id': uuid.uuid4().hex,
+            'survey': survey,
+            'time': time.time() if when is None else when,
+            'user': user,
+            'running': running}
+
+# This class is the outbox file. Events are appended by the monitor and
+# read back in batches by the sender, from another thread, so both go
+# through a lock.
+class Outbox:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, 'a+b')
+        self.size = self._repair()
+        self.offset = min(self._read_offset(), self.size)
+        self.pending = self._count(self.offset)
+
+    # Cuts off a last line that a crash left half written, and returns
+    # the size of the file.
+    def _repair(self):
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        end = size
+        while end > 0:
+            start = max(0, end - 4096)
+            self.file.seek(start)
+            block = self.file.read(end - start)
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            self.file.truncate(end)
+        return end
+
+    def _read_offset(self):
+        try:
+            with open(self.path + '.sent') as sent:
+                return int(sent.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_offset(self):
+        temporary = self.path + '.sent.tmp'
+        with open(temporary, 'w') as sent:
+            sent.write('%d\n' % self.offset)
+        os.replace(temporary, self.path + '.sent')
+
+    def _count(self, offset):
+        self.file.seek(offset)
+        return sum(block.count(b'\n')
+                   for block in iter(lambda: self.file.read(65536), b''))
+
+    # Appends an event and waits until it is on disk. An event that
+    # could not be written whole is cut off again, so that the next one
+    # still starts a line of its own, and the OSError is raised.
+    def append(self, event):
+        line = json.dumps(event, separators=(',', ':')).encode() + b'\n'
+        with self.lock:
+            fd = self.file.fileno()
+            try:
+                if os.write(fd, line) != len(line):
+                    raise OSError(errno.ENOSPC, "Short write to the outbox")
+                os.fsync(fd)
+            except OSError:
+                try:
+                    os.ftruncate(fd, self.size)
+                except OSError:
+                    pass
+                raise
+            self.size += len(line)
+            self.pending += 1
+
+    # Returns up to limit of the oldest undelivered events, as encoded
+    # JSON, and where they end in the file.
+    def batch(self, limit):
+        with self.lock:
+            self.file.seek(self.offset)
+            lines = []
+            end = self.offset
+            while len(lines) < limit and end < self.size:
+                line = self.file.readline()
+                if not line:
+                    break
+                lines.append(line.rstrip(b'\n'))
+                end += len(line)
+            return lines, end
+
+    # Marks the events of a batch as delivered.
+    def acknowledge(self, count, end):
+        with self.lock:
+            self.offset = end
+            self.pending -= count
+            if not self.pending and self.size >= COMPACT_SIZE:
+                self.file.truncate(0)
+                self.offset = self.size = 0
+            self._write_offset()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+# This class delivers batches of events to an endpoint. The connection
+# is opened on the first batch and kept for the next ones; an endpoint
+# that closed it in the meantime gets the batch again on a fresh one.
+class Sender:
+    def __init__(self, endpoint, timeout):
+        url = urllib.parse.urlsplit(endpoint)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise Exception("Bad outbox endpoint %s" % endpoint)
+        self.endpoint = endpoint
+        self.secure = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path or '/'
+        if url.query:
+            self.path += '?' + url.query
+        self.timeout = timeout
+        self.connection = None
+        self.connections = 0
+        self.requests = 0
+
+    def connect(self):
+        if self.secure:
+            self.connection = http.client.HTTPSConnection(self.host,
+                    self.port, timeout=self.timeout)
+        else:
+            self.connection = http.client.HTTPConnection(self.host,
+                    self.port, timeout=self.timeout)
+        self.connections += 1
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    # Posts a batch of encoded events, raising an exception unless the
+    # endpoint accepted it.
+    def send(self, lines):
+        body = b'{"events":[' + b','.join(lines) + b']}'
+        reused = self.connection is not None
+        try:
+            status, reason = self._post(body)
+        except (OSError, http.client.HTTPException):
+            self.close()
+            if not reused:
+                raise
+            status, reason = self._post(body)
+        if not 200 <= status < 300:
+            raise Exception("The endpoint answered %d %s" % (status, reason))
+
+    def _post(self, body):
+        if self.connection is None:
+            self.connect()
+        self.requests += 1
+        try:
+            self.connection.request('POST', self.path, body,
+                    {'Content-Type': 'application/json'})
+            response = self.connection.getresponse()
+            # The answer has to be read for the connection to be reused.
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+        if response.will_close:
+            self.close()
+        return response.status, response.reason
+
+# Returns the request handler of the stand-in endpoint, which fails the
+# given fraction of the requests with a 503.
+def collector_handler(fail):
+    class CollectorHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            if random.random() < fail:
+                self.answer(503, b'failing on purpose\n')
+                return
+            try:
+                events = json.loads(body)['events']
+            except (ValueError, KeyError, TypeError):
+                self.answer(400, b'expected {"events": [...]}\n')
+                return
+            for event in events:
+                print(json.dumps(event, sort_keys=True))
+            self.answer(200, b'ok\n')
+
+        def answer(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            print("%s %s" % (self.client_address[0], format % args))
+    return CollectorHandler
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="A stand-in endpoint for the trigger outbox.")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--fail', type=float, default=0.0,
+                        help="fraction of the requests to fail")
+    args = parser.parse_args()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', args.port),
+                                             collector_handler(args.fail))
+    print("Collecting trigger events on http://127.0.0.1:%d/" % args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+File: proc_events.py
+
+Description:
+Sources of process start and exit events on Linux. The monitor uses
+these instead of walking the whole process list in a loop, so that an
+idle desktop costs close to nothing and only the processes that changed
+are classified. The preferred source subscribes to the kernel's proc
+connector over netlink, which reports fork, exec and exit events as
+they happen. Subscribing needs CAP_NET_ADMIN, so when that is refused
+we fall back to diffing the listing of /proc at a fixed interval.
+"""
+import errno
+import os
+import select
+import socket
+import struct
+
+# Constants from linux/netlink.h, linux/connector.h and linux/cn_proc.h.
+NETLINK_CONNECTOR = 11
+NLMSG_DONE = 3
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+PROC_CN_MCAST_LISTEN = 1
+PROC_CN_MCAST_IGNORE = 2
+PROC_EVENT_FORK = 0x00000001
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_EXIT = 0x80000000
+
+NLMSGHDR = struct.Struct("=IHHII")
+CN_MSG = struct.Struct("=IIIIHH")
+PROC_EVENT = struct.Struct("=IIQ")
+FORK_EVENT = struct.Struct("=IIII")
+EXEC_EVENT = struct.Struct("=II")
+EXIT_EVENT = struct.Struct("=II")
+
+# How long to wait between full rescans when events are delivered by
+# the kernel, and between two listings of /proc otherwise.
+RESYNC_INTERVAL = 60
+LISTING_INTERVAL = 1
+
+# This class receives process events from the kernel's proc connector.
+# Only events for whole processes are reported; threads are ignored. A
+# process that calls exec is reported as started again, since its name
+# and cmdline may have changed.
+class ProcConnectorSource:
+    name = "proc connector"
+    timeout = RESYNC_INTERVAL
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                  NETLINK_CONNECTOR)
+        try:
+            self.sock.bind((0, CN_IDX_PROC))
+            self._control(PROC_CN_MCAST_LISTEN)
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.setblocking(False)
+
+    def _control(self, op):
+        payload = struct.pack("=I", op)
+        cn_msg = CN_MSG.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0,
+                             len(payload), 0)
+        length = NLMSGHDR.size + len(cn_msg) + len(payload)
+        header = NLMSGHDR.pack(length, NLMSG_DONE, 0, 0,
+                               self.sock.getsockname()[0])
+        self.sock.send(header + cn_msg + payload)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    # Drains every pending message and returns the sets of started and
+    # exited pids. None is returned if the kernel dropped messages
+    # because we fell behind, in which case the caller has to rescan.
+    def read_events(self):
+        started = set()
+        exited = set()
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    return None
+                raise
+            self._parse(data, started, exited)
+        return started, exited
+
+    def _parse(self, data, started, exited):
+        offset = 0
+        while offset + NLMSGHDR.size <= len(data):
+            length = NLMSGHDR.unpack_from(data, offset)[0]
+            if length < NLMSGHDR.size:
+                break
+            event = offset + NLMSGHDR.size + CN_MSG.size
+            what = PROC_EVENT.unpack_from(data, event)[0]
+            body = event + PROC_EVENT.size
+            if what == PROC_EVENT_FORK:
+                _, _, pid, tgid = FORK_EVENT.unpack_from(data, body)
+                if pid == tgid:
+                    started.add(pid)
+            elif what == PROC_EVENT_EXEC:
+                pid, tgid = EXEC_EVENT.unpack_from(data, body)
+                started.add(tgid)
+            elif what == PROC_EVENT_EXIT:
+                pid, tgid = EXIT_EVENT.unpack_from(data, body)
+                if pid == tgid:
+                    exited.add(pid)
+                    started.discard(pid)
+            offset += (length + 3) & ~3
+
+    def close(self):
+        try:
+            self._control(PROC_CN_MCAST_IGNORE)
+        except OSError:
+            pass
+        self.sock.close()
+
+# This class finds started and exited processes by comparing two
+# listings of /proc. It is used when the proc connector is not
+# available, and reports changes at most LISTING_INTERVAL late.
+class ProcListingSource:
+    name = "/proc listing"
+    timeout = LISTING_INTERVAL
+
+    def __init__(self):
+        self.pids = list_pids()
+
+    def fileno(self):
+        return None
+
+    def read_events(self):
+        pids = list_pids()
+        started = pids - self.pids
+        exited = self.pids - pids
+        self.pids = pids
+        return started, exited
+
+    def close(self):
+        pass
+
+# This class watches individual processes through pidfds, which become
+# readable as soon as the process exits. The monitor uses it for the
+# browser processes it is tracking, so a browser closing is noticed
+# immediately even when the events come from the /proc listing.
+class PidfdWatcher:
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.fds = {}
+        self.pids = {}
+
+    def fileno(self):
+        return self.epoll.fileno()
+
+    def watched(self):
+        return list(self.fds)
+
+    # Starts watching a pid. Returns False if the process is already
+    # gone, in which case the caller should treat it as exited.
+    def watch(self, pid):
+        if pid in self.fds:
+            return True
+        try:
+            fd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            return False
+        self.epoll.register(fd, select.EPOLLIN)
+        self.fds[pid] = fd
+        self.pids[fd] = pid
+        return True
+
+    def unwatch(self, pid):
+        fd = self.fds.pop(pid, None)
+        if fd is None:
+            return
+        del self.pids[fd]
+        self.epoll.unregister(fd)
+        os.close(fd)
+
+    # Returns the set of watched pids that have exited, and stops
+    # watching them.
+    def read_events(self):
+        exited = set()
+        for fd, mask in self.epoll.poll(0):
+            pid = self.pids.get(fd)
+            if pid is not None:
+                exited.add(pid)
+                self.unwatch(pid)
+        return exited
+
+    def close(self):
+        for pid in self.watched():
+            self.unwatch(pid)
+        self.epoll.close()
+
+def list_pids():
+    pids = set()
+    with os.scandir('/proc') as entries:
+        for entry in entries:
+            if entry.name.isdigit():
+                pids.add(int(entry.name))
+    return pids
+
+# Returns the best event source that we are allowed to open.
+def open_event_source():
+    try:
+        return ProcConnectorSource()
+    except OSError:
+        return ProcListingSource()
+
+# Returns a PidfdWatcher, or None if the running kernel or Python does
+# not support pidfds (Linux 5.3 and Python 3.9 are needed).
+def open_exit_watcher():
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        return None
+    return PidfdWatcher()
@@ -12,18 +12,57 @@ process list of the client's machine for new instances of firefox,
 chrome, safari, etc. When the browsing session is closed, the user will
 be promopted to answer survey questions.
 """
-import psutil
 from sys import platform
-import os
 import configparser
+import importlib.util
+import journal
+import os
+import random
+import re
+import signal
+import stat
+import sys
+import threading
 import time
+import types
+import zlib
+
+# Returns a module that is only loaded the first time one of its
+# attributes is used. Importing this file should be cheap and have no
+# side effects, so that tools such as bench_scan.py and the login agent
+# start quickly, and the heavy modules are only loaded by the code that
+# needs them: psutil is not needed by the /proc scanner, and asyncio
+# only by main().
+def lazy_import(name):
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    # Like import, make a submodule an attribute of its package.
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+psutil = lazy_import('psutil')
+asyncio = lazy_import('asyncio')
+concurrent_futures = lazy_import('concurrent.futures')
+http_server = lazy_import('http.server')
+json = lazy_import('json')
+outbox = lazy_import('outbox')
 
 """
 The following imports are not necessary for the script, but are required
 for the packaging into an application and creating the graphical
-installer.
+installer. The bundlers find them by reading the code, so they are
+listed in a function that never runs rather than imported at startup.
 """
-if platform == "darwin":
+def bundled_modules():
     import six
     import packaging
     import packaging.version
@@ -32,90 +71,302 @@ if platform == "darwin":
     import packaging.requirements
     import _sysconfigdata_m_darwin_darwin
 
+# Each browser is a bit in the masks of running browsers, the bit of its
+# index in journal.BROWSERS.
+BROWSER_BITS = dict((browser, 1 << index)
+                    for index, browser in enumerate(journal.BROWSERS))
+TOR_BIT = BROWSER_BITS['tor']
+ALL_BROWSERS = (1 << len(journal.BROWSERS)) - 1
+
+# The surveys, in the order of SURVEY_NAMES.
+NONTOR = 0
+SWITCHED = 1
+TOR = 2
+
+# The survey trigger that is set when any browser of a mask exits.
+TRIGGER_MASKS = ((ALL_BROWSERS & ~TOR_BIT, journal.TRIGGER_SURVEY),
+                 (TOR_BIT, journal.TRIGGER_TOR_SURVEY))
+
+# Added to the triggers to look up TRIGGERED_SURVEYS while Tor Browser
+# is running.
+TOR_RUNNING = 4
+
+# The survey that the triggers call for and the triggers it clears,
+# indexed by the triggers plus TOR_RUNNING. Closing another browser
+# while Tor Browser runs means the user switched, which also answers a
+# pending Tor Browser survey.
+TRIGGERED_SURVEYS = (
+    (None, 0),
+    (NONTOR, journal.TRIGGER_SURVEY),
+    (TOR, journal.TRIGGER_TOR_SURVEY),
+    (NONTOR, journal.TRIGGER_SURVEY),
+    (None, 0),
+    (SWITCHED, journal.TRIGGER_SURVEY | journal.TRIGGER_TOR_SURVEY),
+    (TOR, journal.TRIGGER_TOR_SURVEY),
+    (SWITCHED, journal.TRIGGER_SURVEY | journal.TRIGGER_TOR_SURVEY),
+)
+
+# Returns the survey triggers that the browsers of a mask set by
+# exiting.
+def exit_triggers(stopped):
+    triggers = 0
+    for browsers, trigger in TRIGGER_MASKS:
+        if stopped & browsers:
+            triggers |= trigger
+    return triggers
+
+# Returns the indexes of the browsers in a mask, lowest first.
+def mask_indexes(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
 # This class contains flags that are used to decide whether or not a
 # survey should be displayed to the user. These flags are populated
-# through constant checks on the process list.
+# through constant checks on the process list. The running browsers
+# are a mask of BROWSER_BITS, and the survey triggers a mask of the
+# journal TRIGGER_ flags, so every scan costs a few integer operations
+# however many browsers there are.
 class BrowserState:
     def __init__(self):
-        self.tor_state = False
-        self.firefox_state = False
-        self.safari_state = False
-        self.chrome_state = False
-        self.opera_state = False
-        self.edge_state = False
-        self.trigger_survey = False
-        self.trigger_tor_survey = False
-        self.NONTOR = 0
-        self.SWITCHED = 1
-        self.TOR = 2
+        self.running = 0
+        self.triggers = 0
+        self.NONTOR = NONTOR
+        self.SWITCHED = SWITCHED
+        self.TOR = TOR
         #self.first_run = True
+        # After a survey is displayed no other survey is displayed for a
+        # while. Surveys triggered in the meantime are handled by the
+        # cooldown policy: 'drop' forgets them, 'coalesce' remembers
+        # the latest one and 'queue' remembers all of them, to be
+        # displayed once the cooldown is over.
+        self.cooldown = SLEEPTIME
+        self.policy = 'coalesce'
+        # The cooldown starts once the survey has been displayed. Until
+        # then the survey handed to the dispatcher holds the others
+        # back, and one that fails to open is tried again after
+        # SURVEY_RETRY seconds.
+        self.last_survey = 0
+        self.cooldown_until = 0
+        self.displaying = None
+        self.retry_until = 0
+        self.pending = []
+        # The number of instances of each browser, that is of root
+        # processes, and of the child processes under them, as of the
+        # last scan, indexed like journal.BROWSERS.
+        self.instances = [0] * len(journal.BROWSERS)
+        self.children = [0] * len(journal.BROWSERS)
+
+    def is_running(self, name):
+        return bool(self.running & BROWSER_BITS[name])
+
+    # Takes the mask of the browsers running now, sets the triggers of
+    # the ones that exited and returns the masks of the browsers that
+    # started and stopped.
+    def update(self, running):
+        started = running & ~self.running
+        stopped = self.running & ~running
+        self.running = running
+        if stopped:
+            self.triggers |= exit_triggers(stopped)
+        return started, stopped
+
+    # Records the process counts of a browser and returns what happened
+    # to it: 'launched' or 'exited' when it starts or stops running,
+    # 'opened' or 'closed' when it gains or loses an instance but keeps
+    # running, None otherwise.
+    def set_counts(self, index, instances, children):
+        before = self.instances[index]
+        self.instances[index] = instances
+        self.children[index] = children
+        if instances == before:
+            return None
+        if before == 0:
+            return 'launched'
+        if instances == 0:
+            return 'exited'
+        if instances > before:
+            return 'opened'
+        return 'closed'
+
+    # Returns the survey triggers as the flags recorded in the journal.
+    def trigger_flags(self):
+        return self.triggers
+
+    # Returns the triggered survey, if any, and clears its trigger.
+    def triggered_survey(self):
+        key = self.triggers
+        if self.running & TOR_BIT:
+            key |= TOR_RUNNING
+        which, cleared = TRIGGERED_SURVEYS[key]
+        self.triggers &= ~cleared
+        return which
+
+    # Takes the survey that was just triggered, or None, and returns the
+    # survey that should be displayed now, if any. This is where the
+    # cooldown and its policy are applied.
+    def survey_due(self, which, now):
+        held = (now < self.cooldown_until or now < self.retry_until
+                or self.displaying is not None)
+        if which is not None and held:
+            if self.policy == 'queue':
+                self.pending.append(which)
+            elif self.policy == 'coalesce':
+                self.pending = [which]
+            elif self.policy != 'drop':
+                raise Exception("Unknown cooldown policy %s" % self.policy)
+            return None
+        if which is None:
+            if held or not self.pending:
+                return None
+            which = self.pending.pop(0)
+        elif self.policy != 'queue':
+            self.pending = []
+        self.displaying = which
+        return which
+
+    # Starts the cooldown once the survey returned by survey_due has
+    # been displayed.
+    def displayed(self, now):
+        self.displaying = None
+        self.last_survey = now
+        self.cooldown_until = now + self.cooldown
+
+    # Puts the survey returned by survey_due back in front of the
+    # pending ones when it failed to open. A survey the policy kept in
+    # the meantime is newer, and is the one kept by 'coalesce'.
+    def display_failed(self, now):
+        which = self.displaying
+        self.displaying = None
+        self.retry_until = now + SURVEY_RETRY
+        if self.policy == 'queue':
+            self.pending.insert(0, which)
+        elif not self.pending:
+            self.pending = [which]
+
+    # Shortens a wait so that a pending survey is not displayed late. A
+    # timeout of None means waiting for ever. While a survey is being
+    # displayed, the dispatcher wakes the state task up when it is done.
+    def wait_limit(self, timeout, now):
+        if self.pending and self.displaying is None:
+            remaining = max(0, self.cooldown_until - now,
+                            self.retry_until - now)
+            if timeout is None:
+                return remaining
+            return min(timeout, remaining)
+        return timeout
 
-    def firefox_running(self):
-        self.firefox_state = True
-
-    def chrome_running(self):
-        self.chrome_state = True 
-
-    def safari_running(self):
-        self.safari_state = True
-
-    def tor_running(self):
-        self.tor_state = True
-        #if not self.first_run and time.time() >= LASTSURVEY + 86400:
-        #    self.trigger_tor_survey = True
-        #self.first_run = False
-
-    def opera_running(self):
-        self.opera_state = True
-
-    def edge_running(self):
-        self.edge_state = True
-
-    def firefox_off(self):
-        if self.firefox_state:
-            self.trigger_survey = True
-        self.firefox_state = False
-
-    def chrome_off(self):
-        if self.chrome_state:
-            self.trigger_survey = True
-        self.chrome_state = False
-
-    def safari_off(self):
-        if self.safari_state:
-            self.trigger_survey = True
-        self.safari_state = False
-
-    def tor_off(self):
-        if self.tor_state:
-            self.trigger_tor_survey = True
-        self.tor_state = False
-
-    def opera_off(self):
-        if self.opera_state:
-            self.trigger_survey = True
-        self.opera_state = False
-
-    def edge_off(self):
-        if self.edge_state:
-            self.trigger_survey = True
-        self.edge_state = False
-
-    def deactivate_survey(self):
-        self.trigger_survey = False
+    def reset(self):
+        self.running = 0
+        self.triggers = 0
+
+# This class keeps running totals of what the scanners did. Every
+# process costs a name read, but cmdline and environ are only read for
+# processes whose name already matches one of the rules in variables,
+# so the difference between the counters shows how many of the
+# expensive reads were avoided. The counters are plain integers bumped
+# on the hot path, and are only formatted when the metrics are exported.
+class ScanCounters:
+    def __init__(self):
+        self.reset()
 
-    def deactivate_tor_survey(self):
-        self.trigger_tor_survey = False
+    def avoided(self):
+        return self.name_reads - self.cmdline_reads
 
     def reset(self):
-        self.tor_state = False
-        self.firefox_state = False
-        self.safari_state = False
-        self.chrome_state = False
-        self.opera_state = False
-        self.edge_state = False
-        self.trigger_survey = False
-        self.trigger_tor_survey = False
+        self.scans = 0
+        self.visited = 0
+        self.tree_hits = 0
+        self.name_reads = 0
+        self.cmdline_reads = 0
+        self.environ_reads = 0
+        self.no_such_process = 0
+        self.access_denied = 0
+        self.matches = {}
+        self.scan_seconds = 0.0
+        self.scan_seconds_max = 0.0
+        self.last_scan_seconds = 0.0
+
+    def summary(self):
+        return {'scans': self.scans,
+                'visited': self.visited,
+                'tree_hits': self.tree_hits,
+                'name_reads': self.name_reads,
+                'cmdline_reads': self.cmdline_reads,
+                'environ_reads': self.environ_reads,
+                'avoided_reads': self.avoided(),
+                'no_such_process': self.no_such_process,
+                'access_denied': self.access_denied,
+                'matches': dict(self.matches),
+                'scan_seconds': self.scan_seconds,
+                'scan_seconds_max': self.scan_seconds_max,
+                'last_scan_seconds': self.last_scan_seconds}
+
+    # Adds up the reads and errors that a thread of the parallel scan
+    # counted on its own.
+    def merge(self, other):
+        self.name_reads += other.name_reads
+        self.cmdline_reads += other.cmdline_reads
+        self.environ_reads += other.environ_reads
+        self.no_such_process += other.no_such_process
+        self.access_denied += other.access_denied
+
+    def scan_done(self, seconds, visited):
+        self.scans += 1
+        self.visited += visited
+        self.scan_seconds += seconds
+        self.last_scan_seconds = seconds
+        if seconds > self.scan_seconds_max:
+            self.scan_seconds_max = seconds
+
+scan_counters = ScanCounters()
+
+# The following functions read the expensive process attributes only
+# when they are needed. A process that refuses access is treated the
+# same way as_dict() did, by reporting None for the attribute.
+def read_cmdline(proc):
+    scan_counters.cmdline_reads += 1
+    try:
+        return proc.cmdline()
+    except psutil.AccessDenied:
+        scan_counters.access_denied += 1
+        return None
+
+def read_environ(proc):
+    scan_counters.environ_reads += 1
+    try:
+        return proc.environ()
+    except psutil.AccessDenied:
+        scan_counters.access_denied += 1
+        return None
+
+# Returns the user a process runs as: its effective uid on unix-like
+# systems and its user name on windows. None is returned if we are not
+# allowed to know.
+def read_owner(proc):
+    try:
+        if platform == "win32":
+            return proc.username()
+        return proc.uids().effective
+    except psutil.AccessDenied:
+        scan_counters.access_denied += 1
+        return None
+
+# Returns a process attribute as a single string, which is what the
+# browser rules are matched against.
+def read_field(proc, field):
+    if field == 'cmdline':
+        cmdline = read_cmdline(proc)
+        if not cmdline:
+            return ''
+        return ' '.join(cmdline)
+    elif field == 'environ':
+        environ = read_environ(proc)
+        if not environ:
+            return ''
+        return ' '.join('%s=%s' % item for item in environ.items())
+    raise Exception("Unknown process field %s" % field)
 
 # Step zero: check the platform and determine what the appropriate
 # process check is depending on the results. Set the process_check
@@ -123,9 +374,1055 @@ class BrowserState:
 # determining the platform we will load a unique identifier and 
 # other information, such as the onion address of the server
 # listening for submissions.
-LASTSURVEY = 0
-SLEEPTIME = 900 #Sleep for 15 minutes after browser is launched.
+SLEEPTIME = 900 #No new survey for 15 minutes after one is displayed.
+SURVEY_RETRY = 60 #A survey that failed to open is tried again after a minute.
+
+# Default survey settings, written to the SURVEY section of the
+# configuration file. See BrowserState for the cooldown policies.
+SURVEY_DEFAULTS = {
+    'cooldown': float(SLEEPTIME),
+    'policy': 'coalesce',
+}
+
+# Default scan cadence, in seconds. These are written to the SCHEDULER
+# section of the configuration file so they can be tuned per
+# deployment.
+SCHEDULE_DEFAULTS = {
+    'idle_interval': 5.0,    # No browser is running.
+    'active_interval': 2.0,  # A browser is running and nothing changes.
+    'fast_interval': 0.5,    # Right after a launch or during a shutdown.
+    'fast_period': 30.0,     # How long to keep scanning fast.
+    'max_interval': 20.0,    # Upper bound for the backoff.
+    'backoff': 1.5,          # Growth factor while nothing changes.
+    'jitter': 0.1,           # Random spread, as a fraction of the delay.
+}
+
+# This class owns the scan cadence of the main loop. It scans slowly
+# when no browser is running, quickly right after a browser launched or
+# while one seems to be shutting down (it lost processes but not all of
+# them), and backs off exponentially while nothing changes. Every delay
+# is jittered so that many installs do not scan in lockstep.
+#
+# It also measures what the scans cost and how late changes are seen.
+# The latency of a change is bounded by the time since the previous
+# scan, which is what we record, so the two can be weighed against each
+# other when tuning the intervals.
+class ScanScheduler:
+    def __init__(self, settings):
+        self.configure(settings)
+        self.unchanged = 0
+        self.fast_until = 0
+        self.counts = {}
+        self.last_scan = None
+        self.scan_cpu = 0
+        self.scans = 0
+        self.changes = 0
+        self.cpu_time = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    # Takes the intervals from the SCHEDULER settings. Called again when
+    # the configuration is reloaded.
+    def configure(self, settings):
+        self.idle_interval = settings['idle_interval']
+        self.active_interval = settings['active_interval']
+        self.fast_interval = settings['fast_interval']
+        self.fast_period = settings['fast_period']
+        self.max_interval = settings['max_interval']
+        self.backoff = settings['backoff']
+        self.jitter = settings['jitter']
+
+    def next_delay(self):
+        if time.time() < self.fast_until:
+            delay = self.fast_interval
+        else:
+            base = self.active_interval if self.counts else self.idle_interval
+            delay = min(base * self.backoff ** self.unchanged,
+                        max(base, self.max_interval))
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def scan_started(self):
+        self.scan_cpu = time.process_time()
+
+    # Called after every scan with the number of processes found for
+    # each running browser.
+    def scan_finished(self, counts):
+        now = time.time()
+        self.cpu_time += time.process_time() - self.scan_cpu
+        self.scans += 1
+
+        launched = False
+        shutting_down = False
+        for browser, count in counts.items():
+            previous = self.counts.get(browser, 0)
+            if not previous:
+                launched = True
+            elif count < previous:
+                shutting_down = True
+
+        if counts != self.counts:
+            self.changes += 1
+            self.unchanged = 0
+            if self.last_scan is not None:
+                latency = now - self.last_scan
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+        else:
+            self.unchanged += 1
+        if launched or shutting_down:
+            self.fast_until = now + self.fast_period
+
+        self.counts = dict(counts)
+        self.last_scan = now
+
+    def summary(self):
+        latency_mean = 0.0
+        if self.changes:
+            latency_mean = self.latency_total / self.changes
+        cpu_per_scan = 0.0
+        if self.scans:
+            cpu_per_scan = self.cpu_time / self.scans
+        return {'scans': self.scans,
+                'changes': self.changes,
+                'cpu_seconds': self.cpu_time,
+                'cpu_per_scan': cpu_per_scan,
+                'latency_mean': latency_mean,
+                'latency_max': self.latency_max}
+
+    def report(self):
+        return ("%(scans)d scans, %(cpu_seconds).3fs CPU "
+                "(%(cpu_per_scan).4fs per scan), detection latency at most "
+                "%(latency_mean).2fs on average and %(latency_max).2fs worst"
+                % self.summary())
+
+# Default CPU budget settings, written to the GOVERNOR section of the
+# configuration file. The budget is a percentage of one core; 0 turns
+# the governor off.
+GOVERNOR_DEFAULTS = {
+    'budget': 0.5,       # Percent of one core the monitor may use.
+    'window': 60.0,      # Seconds the usage is averaged over.
+    'max_stretch': 8.0,  # Most the scan intervals are stretched by.
+    'nice': 10,          # Niceness to run at on Linux, 0 to leave it.
+}
+
+# In the roots tier, one scan in this many still walks the whole
+# process table, so that launches are seen.
+ROOTS_TIER_FULL_EVERY = 4
+
+# How quickly the CPU time of a scan cycle is averaged.
+CYCLE_WEIGHT = 0.3
+
+# The stretch at which the scan intervals count as throttled.
+THROTTLE_THRESHOLD = 1.2
+
+# This class keeps the monitor within a CPU budget. After every scan it
+# measures the CPU time our own process used, through psutil, and keeps
+# a running average of it both as a share of a core and per scan cycle.
+# From the cost of a cycle it works out how long a cycle has to last to
+# stay within the budget, and stretches the delays of the scheduler to
+# that, up to max_stretch. When even that is not enough the poll
+# scanner drops to the roots tier, where most scans only check that the
+# root processes of the running browsers are still there; closing a
+# browser is still seen at once, a launch at the next full scan. It
+# goes back to full scans once the usage is under half the budget.
+class CpuGovernor:
+    def __init__(self, settings):
+        self.configure(settings)
+        self.process = None
+        self.last_cpu = None
+        self.last_wall = None
+        self.usage = 0.0
+        self.cycle_cpu = None
+        self.stretch = 1.0
+        self.tier = 'full'
+        self.cheap_tier = False
+        self.since_full = 0
+        self.throttling = False
+        self.holding = False
+        self.throttled = 0
+        self.root_scans = 0
+        self.decisions = 0
+
+    # Takes the budget from the GOVERNOR settings. Called again when the
+    # configuration is reloaded.
+    def configure(self, settings):
+        self.budget = settings['budget']
+        self.window = settings['window']
+        self.max_stretch = settings['max_stretch']
+        self.nice = settings['nice']
+        if not self.budget:
+            self.stretch = 1.0
+            self.set_tier('full')
+            self.set_throttling(False)
+            self.set_holding(False)
+
+    # Lowers the scheduling priority of the monitor on Linux, so the CPU
+    # it does use yields to the participant's own work. Linux keeps a
+    # niceness per thread that new threads inherit, so this is done
+    # before any thread is started. Returns the niceness, or None if it
+    # was left alone.
+    def lower_priority(self):
+        if platform != "linux" or not self.nice:
+            return None
+        current = os.getpriority(os.PRIO_PROCESS, 0)
+        if current < self.nice:
+            os.setpriority(os.PRIO_PROCESS, 0, self.nice)
+        return max(current, self.nice)
+
+    # Measures the CPU time the monitor used since the previous sample,
+    # and moves to the tier it calls for.
+    def sample(self, now):
+        if self.process is None:
+            self.process = psutil.Process()
+        times = self.process.cpu_times()
+        cpu = times.user + times.system
+        if self.last_wall is not None and now > self.last_wall:
+            used = cpu - self.last_cpu
+            elapsed = now - self.last_wall
+            weight = min(1.0, elapsed / self.window)
+            self.usage += weight * (100 * used / elapsed - self.usage)
+            if self.cycle_cpu is None:
+                self.cycle_cpu = used
+            else:
+                self.cycle_cpu += CYCLE_WEIGHT * (used - self.cycle_cpu)
+        self.last_cpu = cpu
+        self.last_wall = now
+        if not self.budget:
+            return
+        if (self.tier == 'full' and self.cheap_tier
+            and self.usage > self.budget
+            and self.stretch >= self.max_stretch):
+            self.set_tier('roots')
+        elif self.tier == 'roots' and self.usage < self.budget / 2:
+            self.set_tier('full')
+
+    # Returns how long a scan cycle has to last for its CPU time to fit
+    # the budget.
+    def cycle_seconds(self):
+        if not self.budget or self.cycle_cpu is None:
+            return 0.0
+        return self.cycle_cpu * 100 / self.budget
+
+    # Returns how long to wait before the next scan, given the delay the
+    # scheduler asks for.
+    def stretch_delay(self, delay):
+        stretch = 1.0
+        if delay > 0:
+            stretch = min(self.max_stretch,
+                          max(1.0, self.cycle_seconds() / delay))
+        self.stretch = stretch
+        if stretch > 1.0:
+            self.throttled += 1
+        # The jitter of the scheduler moves the stretch about, so
+        # throttling is only reported once it is clear.
+        if self.throttling:
+            self.set_throttling(stretch > 1.0)
+        else:
+            self.set_throttling(stretch > THROTTLE_THRESHOLD)
+        return delay * stretch
+
+    # Returns how long to hold off the next step of the event driven
+    # scanner, at most limit seconds. Events keep queueing in the kernel
+    # meanwhile and are handled in one batch. This only happens while
+    # the usage is over the budget, and like the stretch it only starts
+    # once the usage is clearly over it.
+    def pause(self, now, limit):
+        if self.last_wall is None or not self.budget:
+            return 0.0
+        if self.holding:
+            self.set_holding(self.usage > self.budget)
+        else:
+            self.set_holding(self.usage > self.budget * THROTTLE_THRESHOLD)
+        if not self.holding:
+            return 0.0
+        wait = min(self.cycle_seconds(), limit) - (now - self.last_wall)
+        if wait <= 0:
+            return 0.0
+        self.throttled += 1
+        return wait
+
+    # Returns True if the next scan has to walk the whole process table,
+    # False if checking the roots will do.
+    def full_scan_due(self):
+        if self.tier == 'full':
+            return True
+        self.since_full += 1
+        if self.since_full >= ROOTS_TIER_FULL_EVERY:
+            self.since_full = 0
+            return True
+        self.root_scans += 1
+        return False
+
+    def set_tier(self, tier):
+        if tier != self.tier:
+            self.tier = tier
+            self.since_full = 0
+            self.decisions += 1
+
+    def set_throttling(self, throttling):
+        if throttling != self.throttling:
+            self.throttling = throttling
+            self.decisions += 1
+
+    def set_holding(self, holding):
+        if holding != self.holding:
+            self.holding = holding
+            self.decisions += 1
+
+    def summary(self):
+        return {'budget': self.budget,
+                'usage': self.usage,
+                'cycle_cpu': self.cycle_cpu or 0.0,
+                'stretch': self.stretch,
+                'tier': self.tier,
+                'throttling': self.throttling,
+                'holding': self.holding,
+                'throttled': self.throttled,
+                'root_scans': self.root_scans}
+
+    def report(self):
+        if not self.budget:
+            return "using %(usage).2f%% of a core, no budget" % self.summary()
+        text = ("using %(usage).2f%% of a core against a budget of "
+                "%(budget).2f%%, %(cycle_cpu).4fs CPU per cycle, "
+                "%(tier)s scans" % self.summary())
+        if self.throttling and self.stretch > 1.0:
+            text += ", intervals stretched %.1fx" % self.stretch
+        if self.holding:
+            text += ", holding events back"
+        return text
+
+# Default settings of the parallel scan, written to the PLATFORM section
+# of the configuration file. With fewer than two threads every scan is
+# serial; otherwise a scan that lists at least parallel_threshold
+# processes reads them on that many threads. bench_scan.py --crossover
+# measures where the threads start to pay off on a machine.
+PARALLEL_DEFAULTS = {
+    'scan_threads': 0,
+    'parallel_threshold': 1000,
+}
+
+# Default metrics export settings, written to the METRICS section of
+# the configuration file.
+METRICS_DEFAULTS = {
+    'textfile': '',    # Prometheus text file to keep up to date, if any.
+    'port': 0,         # Port on localhost to serve /metrics on, if any.
+    'interval': 15.0,  # Seconds between two rewrites of the text file.
+}
+
+SURVEY_NAMES = ('nontor', 'switched', 'tor')
+
+# Default journal settings, written to the JOURNAL section of the
+# configuration file. The file is relative to the directory of the
+# configuration file; an empty one turns the journal off. At 16 bytes a
+# record the default capacity takes 1MB.
+JOURNAL_DEFAULTS = {
+    'file': 'journal',
+    'capacity': 65536,
+}
+
+# Seconds between two writes of the batched journal records.
+JOURNAL_FLUSH_INTERVAL = 60
+
+# Default control socket settings, written to the CONTROL section of the
+# configuration file. The socket is relative to the directory of the
+# configuration file; an empty one turns it off.
+CONTROL_DEFAULTS = {
+    'socket': 'control',
+}
+
+# Default trigger outbox settings, written to the OUTBOX section of the
+# configuration file. Trigger events are only kept, and sent, when
+# there is an endpoint to send them to. The file is relative to the
+# directory of the configuration file.
+OUTBOX_DEFAULTS = {
+    'endpoint': '',        # Where the trigger events are posted.
+    'file': 'outbox',
+    'batch': 50,           # Most events posted in one request.
+    'interval': 60.0,      # Seconds events wait to be sent together.
+    'timeout': 10.0,       # Seconds to wait on the endpoint.
+    'max_backoff': 900.0,  # Longest wait between two failed deliveries.
+}
+
+# The queries the control socket answers, see MonitorRuntime.query.
+CONTROL_QUERIES = ('status', 'browsers', 'tor', 'surveys', 'stats', 'help')
+
+# This class collects the instrumentation of the monitor and exports it
+# in the Prometheus text format, either as a file that is rewritten
+# atomically or over HTTP on localhost. The scan counters live in
+# scan_counters and process_cache and are only read here when the
+# metrics are rendered, so collecting them costs next to nothing.
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.transitions = {}
+        self.surveys = {}
+        self.survey_seconds = 0.0
+        self.outbox_delivered = 0
+        self.outbox_failures = 0
+        self.scheduler = None
+        self.governor = None
+        self.textfile = None
+        self.interval = METRICS_DEFAULTS['interval']
+        self.server = None
+
+    def transition(self, browser, running):
+        key = (browser, 'running' if running else 'off')
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+
+    def survey(self, which, seconds):
+        name = SURVEY_NAMES[which]
+        self.surveys[name] = self.surveys.get(name, 0) + 1
+        self.survey_seconds += seconds
+
+    def render(self):
+        lines = []
+        def metric(name, kind, text, samples):
+            lines.append("# HELP tor_measure_%s %s" % (name, text))
+            lines.append("# TYPE tor_measure_%s %s" % (name, kind))
+            for labels, value in samples:
+                label_text = ''
+                if labels:
+                    label_text = '{%s}' % ','.join(
+                            '%s="%s"' % label for label in labels)
+                lines.append("tor_measure_%s%s %s"
+                             % (name, label_text, repr(float(value))))
+
+        counters = scan_counters
+        metric("start_time_seconds", "gauge",
+               "When the monitor started.", [((), self.started)])
+        metric("scans_total", "counter", "Full process scans.",
+               [((), counters.scans)])
+        metric("scan_seconds_total", "counter",
+               "Time spent in full process scans.",
+               [((), counters.scan_seconds)])
+        metric("scan_seconds_max", "gauge",
+               "Longest full process scan.",
+               [((), counters.scan_seconds_max)])
+        metric("last_scan_seconds", "gauge",
+               "Duration of the last full process scan.",
+               [((), counters.last_scan_seconds)])
+        metric("processes_visited_total", "counter",
+               "Processes visited by full scans.", [((), counters.visited)])
+        metric("attribute_reads_total", "counter",
+               "Process attributes read by the scanners.",
+               [((('attribute', 'name'),), counters.name_reads),
+                ((('attribute', 'cmdline'),), counters.cmdline_reads),
+                ((('attribute', 'environ'),), counters.environ_reads)])
+        metric("cmdline_reads_avoided_total", "counter",
+               "Processes whose cmdline was not read because their name "
+               "matched no rule.", [((), counters.avoided())])
+        metric("process_errors_total", "counter",
+               "Processes that vanished or refused access while read.",
+               [((('error', 'no_such_process'),), counters.no_such_process),
+                ((('error', 'access_denied'),), counters.access_denied)])
+        metric("cache_lookups_total", "counter",
+               "Classification cache lookups.",
+               [((('result', 'hit'),), process_cache.hits),
+                ((('result', 'miss'),), process_cache.misses)])
+        metric("cache_evictions_total", "counter",
+               "Processes evicted from the classification cache.",
+               [((), process_cache.evictions)])
+        metric("matches_total", "counter",
+               "Processes classified as a browser.",
+               [((('browser', browser),), count)
+                for browser, count in sorted(dict(counters.matches).items())])
+        metric("browser_processes", "gauge",
+               "Processes currently tracked for each browser.",
+               [((('browser', browser),), count) for browser, count
+                in sorted(dict(process_cache.counts).items())])
+        instances = {}
+        for counts in list(process_cache.user_counts.values()):
+            for browser, (count, children) in counts.running().items():
+                instances[browser] = instances.get(browser, 0) + count
+        metric("browser_instances", "gauge",
+               "Root processes currently tracked for each browser.",
+               [((('browser', browser),), count) for browser, count
+                in sorted(instances.items())])
+        metric("tree_hits_total", "counter",
+               "Processes attributed to a browser through their parent.",
+               [((), counters.tree_hits)])
+        metric("transitions_total", "counter",
+               "BrowserState transitions.",
+               [((('browser', browser), ('state', state)), count)
+                for (browser, state), count
+                in sorted(dict(self.transitions).items())])
+        metric("surveys_total", "counter", "Surveys displayed.",
+               [((('survey', name),), count)
+                for name, count in sorted(dict(self.surveys).items())])
+        metric("survey_seconds_total", "counter",
+               "Time spent opening the surveys that were displayed.",
+               [((), self.survey_seconds)])
+        if trigger_outbox is not None:
+            metric("outbox_pending", "gauge",
+                   "Trigger events waiting to be delivered.",
+                   [((), trigger_outbox.pending)])
+            metric("outbox_delivered_total", "counter",
+                   "Trigger events delivered to the endpoint.",
+                   [((), self.outbox_delivered)])
+            metric("outbox_failures_total", "counter",
+                   "Trigger events that failed to be written to the "
+                   "outbox, and deliveries that failed.",
+                   [((), self.outbox_failures)])
+        if self.scheduler is not None:
+            summary = self.scheduler.summary()
+            metric("scheduler_cpu_seconds_total", "counter",
+                   "CPU time spent in scheduled scans.",
+                   [((), summary['cpu_seconds'])])
+            metric("detection_latency_seconds", "gauge",
+                   "Upper bound on how late changes were seen.",
+                   [((('stat', 'mean'),), summary['latency_mean']),
+                    ((('stat', 'max'),), summary['latency_max'])])
+        if self.governor is not None:
+            summary = self.governor.summary()
+            metric("cpu_usage_percent", "gauge",
+                   "CPU used by the monitor, in percent of one core.",
+                   [((), summary['usage'])])
+            metric("cpu_budget_percent", "gauge",
+                   "CPU budget of the monitor, in percent of one core.",
+                   [((), summary['budget'])])
+            metric("governor_stretch", "gauge",
+                   "Factor the scan intervals are stretched by.",
+                   [((), summary['stretch'])])
+            metric("governor_tier", "gauge",
+                   "The scan tier the governor is in.",
+                   [((('tier', tier),), int(summary['tier'] == tier))
+                    for tier in ('full', 'roots')])
+            metric("governor_throttled_total", "counter",
+                   "Scans or event batches held back by the governor.",
+                   [((), summary['throttled'])])
+            metric("root_scans_total", "counter",
+                   "Scans that only checked the browser root processes.",
+                   [((), summary['root_scans'])])
+        return '\n'.join(lines) + '\n'
+
+    # Writes the metrics to a temporary file next to the text file and
+    # renames it into place, so a reader never sees a partial file.
+    def write_textfile(self, path):
+        temp = path + '.tmp'
+        with open(temp, 'w') as textfile:
+            textfile.write(self.render())
+        os.replace(temp, path)
+
+    def serve(self, port):
+        self.server = http_server.ThreadingHTTPServer(('127.0.0.1', port),
+                                                      metrics_handler())
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  daemon=True)
+        thread.start()
+
+# Returns the request handler for the metrics server. It is only made
+# when the metrics are served, so that http.server is not loaded
+# otherwise.
+def metrics_handler():
+    class MetricsHandler(http_server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+    return MetricsHandler
+
+metrics = Metrics()
+
+# This class holds what the monitor knows about one user: the
+# BrowserState that decides their surveys and the browsers they were
+# last seen running.
+class UserSession:
+    def __init__(self, user, browsers):
+        self.user = user
+        self.name = user_name(user)
+        self.browsers = browsers
+
+# How often the configuration file is checked for changes, in seconds.
+CONFIG_CHECK_INTERVAL = 30
+
+# This class runs the monitor on asyncio. Every part of it is a task of
+# its own, and they talk to each other through queues:
+#
+#   scanner    walks the process list, or follows the process events on
+#              Linux, in an executor so it never blocks the loop, and
+#              puts the set of running browsers on the scans queue.
+#   state      applies those sets to the BrowserState of each user,
+#              decides which survey is due for whom and puts it on the
+#              surveys queue.
+#   dispatcher displays surveys, in the default executor, so a slow
+#              xdg-open or web browser never delays the next scan.
+#   reloader   watches the configuration file and swaps in a new
+#              ConfigSnapshot when it changes.
+#   exporter   rewrites the metrics text file and writes out the
+#              journal.
+#   controller answers queries on the control socket from what the
+#              other tasks already know, so a query never costs a scan.
+#   sender     delivers the trigger events of the outbox to the
+#              collection endpoint, in the default executor, so the
+#              network never holds up the other tasks.
+#
+# All scanning happens on a single executor thread, so the process
+# cache is only ever touched by one thread at a time. However many users
+# are logged in, there is one scan per tick; its results are split by
+# the user owning each browser. With 'users = self' in the PLATFORM
+# section only our own user is followed, with 'all' every user gets a
+# UserSession of their own as soon as one of their browsers shows up.
+class MonitorRuntime:
+    def __init__(self, browsers, config, scheduler, governor):
+        self.config = config
+        self.rejected = None
+        self.scheduler = scheduler
+        self.governor = governor
+        user = current_user()
+        self.sessions = {user: UserSession(user, browsers)}
+        self.configure(self.sessions[user])
+        self.scans = asyncio.Queue()
+        self.surveys = asyncio.Queue()
+        self.outbox_ready = asyncio.Event()
+        self.scan_executor = concurrent_futures.ThreadPoolExecutor(
+                max_workers=1)
+
+    async def run(self):
+        if event_scan is not None:
+            scanner = self.event_scanner()
+        else:
+            scanner = self.poll_scanner()
+            self.governor.cheap_tier = root_scan is not None
+        tasks = [scanner, self.state(), self.dispatcher(),
+                 self.reloader(), self.exporter(), self.controller(),
+                 self.sender()]
+        gathered = asyncio.gather(*[asyncio.create_task(task)
+                                    for task in tasks])
+        # A login agent is stopped with SIGTERM or SIGHUP. They cancel
+        # the tasks, so that their cleanup and that of main() runs as it
+        # does on Ctrl-C: the control socket is removed, and the last
+        # batch of the journal is written.
+        stopped = []
+        if platform != "win32":
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGTERM, signal.SIGHUP):
+                loop.add_signal_handler(signum, self.stop, gathered,
+                                        stopped, signum)
+        try:
+            await gathered
+        except asyncio.CancelledError:
+            if not stopped:
+                raise
+
+    def stop(self, gathered, stopped, signum):
+        print("Stopping on %s" % signal.Signals(signum).name)
+        stopped.append(signum)
+        gathered.cancel()
+
+    # Hands the result of a scan over to the state task.
+    async def publish(self, running):
+        seen_changes = self.scheduler.changes
+        self.scheduler.scan_finished(process_cache.counts)
+        if self.scheduler.changes != seen_changes:
+            print("Scheduler:", self.scheduler.report())
+        self.governor.sample(time.time())
+        await self.scans.put(running)
+
+    # Reports what the governor decided since the last call, if anything.
+    def governor_report(self, seen_decisions):
+        if self.governor.decisions != seen_decisions:
+            print("Governor:", self.governor.report())
+
+    async def poll_scanner(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            seen_decisions = self.governor.decisions
+            if self.scheduler.scans:
+                await asyncio.sleep(self.governor.stretch_delay(
+                        self.scheduler.next_delay()))
+            self.scheduler.scan_started()
+            scan = process_scan
+            if root_scan is not None and not self.governor.full_scan_due():
+                scan = root_scan
+            running = await loop.run_in_executor(self.scan_executor,
+                    scan, self.config.matcher)
+            await self.publish(running)
+            self.governor_report(seen_decisions)
+
+    # On Linux we do not need to walk the process list over and over.
+    # After one full scan, only the processes that an event source
+    # reports as started or exited are looked at. A full scan is still
+    # done now and then, and whenever the source lost events. The root
+    # process of every tracked browser is also watched through a pidfd
+    # when the kernel supports it, so that closing a browser is noticed
+    # the moment it happens whatever the event source.
+    async def event_scanner(self):
+        loop = asyncio.get_running_loop()
+        import proc_events
+        events = proc_events.open_event_source()
+        watcher = proc_events.open_exit_watcher()
+        print("Watching processes through the", events.name)
+        woken = asyncio.Event()
+        def readable(fd):
+            loop.remove_reader(fd)
+            woken.set()
+        last_scan = 0
+        while True:
+            seen_decisions = self.governor.decisions
+            if last_scan:
+                # Only the /proc listing has to be paced by the
+                # scheduler; the kernel wakes us up itself when it has
+                # events.
+                if events.fileno() is None:
+                    timeout = self.governor.stretch_delay(
+                            self.scheduler.next_delay())
+                else:
+                    timeout = events.timeout
+                for waitable in (events, watcher):
+                    if waitable is not None and waitable.fileno() is not None:
+                        loop.add_reader(waitable.fileno(), readable,
+                                waitable.fileno())
+                try:
+                    await asyncio.wait_for(woken.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                woken.clear()
+                # Over the budget, events are left to pile up for a
+                # while and then handled together.
+                pause = self.governor.pause(time.time(),
+                                            self.scheduler.max_interval)
+                if pause:
+                    await asyncio.sleep(pause)
+            resync = time.time() >= (last_scan + proc_events.RESYNC_INTERVAL
+                                     * self.governor.stretch)
+            self.scheduler.scan_started()
+            running, rescanned = await loop.run_in_executor(
+                    self.scan_executor, event_scan, events, watcher,
+                    self.config.matcher, resync)
+            if rescanned:
+                last_scan = time.time()
+            await self.publish(running)
+            self.governor_report(seen_decisions)
+
+    # Sets the survey cooldown and policy of a user from the
+    # configuration.
+    def configure(self, session):
+        settings = self.config.survey_settings(session.name)
+        session.browsers.cooldown = settings['cooldown']
+        session.browsers.policy = settings['policy']
+
+    def update_sessions(self, running):
+        if self.config.users == 'all':
+            for user in running:
+                if user is not None and user not in self.sessions:
+                    session = UserSession(user, BrowserState())
+                    self.configure(session)
+                    self.sessions[user] = session
+        for user, session in self.sessions.items():
+            update_browser_state(session.browsers, running.get(user, {}),
+                    user)
+
+    # Returns how long the state task may wait for a scan before a
+    # pending survey would be late, or None.
+    def wait_limit(self, now):
+        timeout = None
+        for session in self.sessions.values():
+            timeout = session.browsers.wait_limit(timeout, now)
+        return timeout
+
+    async def state(self):
+        while True:
+            # Wake up on our own if a survey is waiting for the end of
+            # the cooldown.
+            timeout = self.wait_limit(time.time())
+            try:
+                running = await asyncio.wait_for(self.scans.get(), timeout)
+                if running is not None:
+                    self.update_sessions(running)
+            except asyncio.TimeoutError:
+                pass
+            # Scanning carries on while a survey is open and during the
+            # cooldown after it, so no launch or switch is missed.
+            now = time.time()
+            for session in list(self.sessions.values()):
+                browsers = session.browsers
+                flags = browsers.trigger_flags()
+                which = browsers.triggered_survey()
+                if which is not None:
+                    record_transition(which, journal.TRIGGERED, flags,
+                            session.user)
+                    await self.record_trigger(session, which, now)
+                if which is not None and now < browsers.cooldown_until:
+                    print("Survey triggered during the cooldown of %s: %s"
+                            % (session.name, SURVEY_NAMES[which]))
+                which = browsers.survey_due(which, now)
+                if which is not None:
+                    print("Displaying %s survey for %s"
+                            % (SURVEY_NAMES[which], session.name))
+                    await self.surveys.put((session, which))
+
+    # Puts a trigger event in the outbox, and wakes the sender up once
+    # there is a full batch. The outbox waits for the disk, so it is
+    # written from the executor; an event that can't be written, say on
+    # a full disk, is reported and counted instead of stopping the
+    # monitor.
+    async def record_trigger(self, session, which, now):
+        if trigger_outbox is None:
+            return
+        running = [BROWSERS[index]
+                   for index in mask_indexes(session.browsers.running)]
+        event = outbox.trigger_event(SURVEY_NAMES[which], session.name,
+                                     running, now)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, trigger_outbox.append, event)
+        except OSError as e:
+            metrics.outbox_failures += 1
+            print("Couldn't write the trigger event to the outbox:", e)
+            return
+        if trigger_outbox.pending >= self.config.outbox_options['batch']:
+            self.outbox_ready.set()
+
+    # A survey that fails to open is reported instead of stopping the
+    # monitor, and handed back to be tried again. Either way the state
+    # task is woken up, with None instead of a scan, to wait for the
+    # cooldown or the retry of what is pending.
+    async def dispatcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            session, which = await self.surveys.get()
+            start = time.time()
+            try:
+                config = self.config
+                await loop.run_in_executor(None, display_survey,
+                        session.browsers, which, config.tor_url,
+                        config.switched_url, config.non_tor_url,
+                        session.user)
+            except Exception as e:
+                print("Couldn't display the survey:", e)
+                session.browsers.display_failed(time.time())
+            else:
+                session.browsers.displayed(time.time())
+                record_transition(which, journal.DISPLAYED,
+                        session.browsers.trigger_flags(), session.user)
+                metrics.survey(which, time.time() - start)
+            await self.scans.put(None)
+
+    # A configuration that fails to read or check is reported once, and
+    # the current one is kept until the file changes again.
+    async def reloader(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(CONFIG_CHECK_INTERVAL)
+            stamp = config_stamp(self.config.location)
+            if stamp == self.config.stamp or stamp == self.rejected:
+                continue
+            try:
+                config = await loop.run_in_executor(None, read_config,
+                        self.config.location)
+            except Exception as e:
+                self.rejected = stamp
+                print("Couldn't reload the configuration:", e)
+                continue
+            self.apply(config)
+            print("Reloaded the configuration.")
+
+    # Swaps in a new configuration. The scanner picks up the new matcher
+    # on its next scan.
+    def apply(self, config):
+        if config.metrics_options != self.config.metrics_options:
+            print("The METRICS settings take effect after a restart.")
+        if config.journal_options != self.config.journal_options:
+            print("The JOURNAL settings take effect after a restart.")
+        if (config.governor_options['nice']
+            != self.config.governor_options['nice']):
+            print("The GOVERNOR niceness takes effect after a restart.")
+        if config.parallel_options != self.config.parallel_options:
+            print("The parallel scan settings take effect after a restart.")
+        if config.control_options != self.config.control_options:
+            print("The CONTROL settings take effect after a restart.")
+        if (config.outbox_options['file'] != self.config.outbox_options['file']
+            or bool(config.outbox_options['endpoint'])
+                != bool(self.config.outbox_options['endpoint'])):
+            print("Turning the outbox on or off, or moving it, takes effect "
+                  "after a restart.")
+        self.config = config
+        for session in self.sessions.values():
+            self.configure(session)
+        self.scheduler.configure(config.schedule)
+        self.governor.configure(config.governor_options)
+
+    # Serves the control socket. Each line a client sends is a query,
+    # answered with a line of JSON, and a client can send as many as it
+    # likes over one connection. Only our own user may connect.
+    async def controller(self):
+        path = control_path(self.config)
+        if path is None:
+            return
+        if not hasattr(asyncio, 'start_unix_server'):
+            print("The control socket needs Unix domain sockets.")
+            return
+        # A socket left behind by a monitor that did not exit cleanly is
+        # replaced, anything else at that path is left alone.
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                print("Not a socket, no control socket at", path)
+                return
+            os.unlink(path)
+        # The socket tells whether Tor Browser is running, so it is
+        # created private rather than made private afterwards.
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.answer, path)
+        finally:
+            os.umask(umask)
+        print("Answering queries on", path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    async def answer(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = self.query(line.decode(errors='replace').strip())
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    # Returns the answer to a query of the control socket, made from the
+    # state of the sessions and the counters of the scanner.
+    def query(self, command):
+        if command == 'help':
+            return {'queries': list(CONTROL_QUERIES)}
+        if command == 'tor':
+            users = [session.name for session in self.sessions.values()
+                     if session.browsers.running & TOR_BIT]
+            return {'running': bool(users), 'users': users}
+        if command == 'browsers':
+            return {'time': time.time(),
+                    'users': dict((session.name, self.browsers_status(session))
+                                  for session in self.sessions.values())}
+        if command == 'surveys':
+            now = time.time()
+            return {'time': now,
+                    'users': dict((session.name,
+                                   self.survey_status(session, now))
+                                  for session in self.sessions.values())}
+        if command == 'stats':
+            return {'time': time.time(),
+                    'scanner': scan_counters.summary(),
+                    'cache': {'processes': len(process_cache.entries),
+                              'tracked': len(process_cache.tracked),
+                              'hits': process_cache.hits,
+                              'misses': process_cache.misses,
+                              'evictions': process_cache.evictions},
+                    'scheduler': self.scheduler.summary(),
+                    'governor': self.governor.summary(),
+                    'outbox': outbox_summary()}
+        if command == 'status':
+            stats = self.query('stats')
+            return {'time': stats.pop('time'),
+                    'tor': self.query('tor'),
+                    'browsers': self.query('browsers')['users'],
+                    'surveys': self.query('surveys')['users'],
+                    'stats': stats}
+        return {'error': "Unknown query %s, try one of %s"
+                % (command, ', '.join(CONTROL_QUERIES))}
+
+    def browsers_status(self, session):
+        browsers = session.browsers
+        return dict((name, {'running': browsers.is_running(name),
+                            'instances': browsers.instances[index],
+                            'children': browsers.children[index]})
+                    for index, name in enumerate(BROWSERS))
+
+    def survey_status(self, session, now):
+        browsers = session.browsers
+        return {'last_survey': browsers.last_survey or None,
+                'cooldown': browsers.cooldown,
+                'cooldown_until': browsers.cooldown_until or None,
+                'cooling': now < browsers.cooldown_until,
+                'cooldown_left': max(0.0, browsers.cooldown_until - now),
+                'policy': browsers.policy,
+                'retry_left': max(0.0, browsers.retry_until - now),
+                'pending': [SURVEY_NAMES[which]
+                            for which in browsers.pending],
+                'trigger_flags': browsers.trigger_flags()}
+
+    # Sends the outbox every interval, or as soon as it holds a full
+    # batch, and what was left in it by the last run right away. A
+    # delivery that fails is tried again after a backoff that doubles
+    # with every failure, up to max_backoff; the events stay in the
+    # outbox until the endpoint takes them.
+    async def sender(self):
+        if trigger_outbox is None:
+            return
+        loop = asyncio.get_running_loop()
+        sender = None
+        failures = 0
+        if trigger_outbox.pending:
+            self.outbox_ready.set()
+        while True:
+            options = self.config.outbox_options
+            if failures:
+                delay = min(options['max_backoff'],
+                            options['interval'] * 2 ** (failures - 1))
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            else:
+                try:
+                    await asyncio.wait_for(self.outbox_ready.wait(),
+                            options['interval'])
+                except asyncio.TimeoutError:
+                    pass
+                self.outbox_ready.clear()
+            options = self.config.outbox_options
+            if not options['endpoint'] or not trigger_outbox.pending:
+                continue
+            if sender is None or sender.endpoint != options['endpoint']:
+                if sender is not None:
+                    sender.close()
+                sender = outbox.Sender(options['endpoint'],
+                                       options['timeout'])
+            sender.timeout = options['timeout']
+            try:
+                await loop.run_in_executor(None, deliver_outbox, sender,
+                        options['batch'])
+            except Exception as e:
+                failures += 1
+                metrics.outbox_failures += 1
+                print("Couldn't deliver %d trigger events (failure %d): %s"
+                      % (trigger_outbox.pending, failures, e))
+            else:
+                failures = 0
+
+    async def exporter(self):
+        loop = asyncio.get_running_loop()
+        exported = flushed = time.time()
+        while True:
+            await asyncio.sleep(min(metrics.interval, JOURNAL_FLUSH_INTERVAL))
+            now = time.time()
+            if metrics.textfile and now >= exported + metrics.interval:
+                await loop.run_in_executor(None, metrics.write_textfile,
+                        metrics.textfile)
+                exported = now
+            if (transitions is not None
+                and now >= flushed + JOURNAL_FLUSH_INTERVAL):
+                transitions.flush()
+                flushed = now
+
 def main():
+    global config
+    select_platform()
+    config = load_config()
     # Step One: Declare the variables we will be using to indicate
     # whether certain browsers are running. Specifically, we will 
     # display a survey prompt when one of these variables go from True
@@ -133,436 +1430,1318 @@ def main():
     # will keep track of this with the BrowserState class we wrote
     # earlier.
     browsers = BrowserState()
+    scheduler = ScanScheduler(config.schedule)
+    metrics.scheduler = scheduler
+    governor = CpuGovernor(config.governor_options)
+    metrics.governor = governor
+    nice = governor.lower_priority()
+    if nice is not None:
+        print("Running at niceness", nice)
+    metrics_options = config.metrics_options
+    if metrics_options['textfile']:
+        metrics.textfile = os.path.expanduser(metrics_options['textfile'])
+        metrics.interval = metrics_options['interval']
+    if metrics_options['port']:
+        metrics.serve(metrics_options['port'])
+    parallel_options = config.parallel_options
+    start_scan_pool(parallel_options['scan_threads'],
+                    parallel_options['parallel_threshold'])
+    open_journal(config)
+    open_outbox(config)
 
     print("Created Browser States. Now enetering Main Loop.")
-    # Last step: enter the process checking loop. This loop will
-    # determine which browsers are running, and based on browsers
-    # opening and closing will decide to trigger the survey.
-    found = {'firefox':False, 'tor':False, 'opera':False, 
-            'safari':False, 'edge':False, 'chrome':False}
-    while True:
-        browsers, found = process_check(browsers, variables, found)
-        if browsers.trigger_survey and not browsers.tor_state:
-            print("Displaying nontor survey")
-            display_survey(browsers, browsers.NONTOR,
-                    tor_url, switched_url, non_tor_url)
-            browsers.deactivate_survey()
-        elif browsers.trigger_survey:
-            print("Displaying switched survey")
-            display_survey(browsers, browsers.SWITCHED,
-                    tor_url, switched_url, non_tor_url)
-            browsers.deactivate_survey()
-            browsers.deactivate_tor_survey()
-        elif browsers.trigger_tor_survey:
-            print("Displaying Tor survey")
-            display_survey(browsers, browsers.TOR,
-                    tor_url, switched_url, non_tor_url)
-            browsers.deactivate_tor_survey()
-
-# The following function checks processes on Linux distributions. It 
-# relies on the cmdline variables to distinguish the Tor Browser Bundle 
-# from Firefox.
-def ul_process_check(browsers, variables, found):
-    firefox = variables['firefox']
-    tor = variables['tor']
-    chrome = variables['chrome']
-    safari = variables['safari']
-    opera = variables['opera']
-
-    found_firefox = False
-    found_tor = False
-    found_chrome = False
-    found_safari = False
-    found_opera = False
-
-    for proc in psutil.process_iter():
+    # Last step: start the monitor. It will determine which browsers
+    # are running, and based on browsers opening and closing will
+    # decide to trigger the survey.
+    runtime = MonitorRuntime(browsers, config, scheduler, governor)
+    try:
+        asyncio.run(runtime.run())
+    finally:
+        if transitions is not None:
+            transitions.close()
+        if trigger_outbox is not None:
+            trigger_outbox.close()
+
+# The fields a browser rule can look at, cheapest first. Every rule in
+# variables needs a 'name', a substring of the process name. Each field
+# can also be required ('cmdline') or forbidden ('not_cmdline') to
+# contain a substring. A rule reports the browser it is named after,
+# unless it gives another one with 'browser', which is how derivatives
+# such as Chromium are counted as Chrome.
+RULE_FIELDS = ('name', 'cmdline', 'environ')
+
+# This class compiles the rules in variables once, so that a process can
+# be classified in a single pass. A combined expression over the rule
+# names rejects the vast majority of processes from the name alone;
+# only for the rest are the rules tried in order, and the cmdline and
+# environ read, at most once each and only if a rule needs them.
+class BrowserMatcher:
+    def __init__(self, variables, binary=False):
+        self.binary = binary
+        self.rules = []
+        self.browser_names = {}
+        names = []
+        for key, rule in variables.items():
+            for option in rule:
+                if (option != 'browser'
+                    and option.replace('not_', '', 1) not in RULE_FIELDS):
+                    raise Exception("Unknown option %s in rule %s"
+                                    % (option, key))
+            predicates = []
+            for field in RULE_FIELDS:
+                for option, wanted in ((field, True), ('not_' + field, False)):
+                    if option in rule and option != 'name':
+                        pattern = re.compile(re.escape(self._text(rule[option])))
+                        predicates.append((field, pattern, wanted))
+            rule_name = self._text(rule['name'])
+            browser = rule.get('browser', key)
+            self.rules.append((browser, rule_name, predicates))
+            self.browser_names.setdefault(browser, []).append(rule_name)
+            names.append(re.escape(rule_name))
+        self.name_filter = re.compile(self._text('|').join(names))
+
+    # A binary matcher works on the raw bytes read from /proc, so that
+    # nothing has to be decoded.
+    def _text(self, value):
+        if self.binary:
+            return value.encode()
+        return value
+
+    # Returns True if the name matches the name of any rule.
+    def named(self, name):
+        return self.name_filter.search(name) is not None
+
+    # Returns True if the name matches the name of a rule for the
+    # browser.
+    def names_browser(self, name, browser):
+        for rule_name in self.browser_names.get(browser, ()):
+            if rule_name in name:
+                return True
+        return False
+
+    # Returns the browser the process belongs to, or None. The name has
+    # already been read; read(proc, field) is called for anything else.
+    def classify(self, name, proc, read):
+        if not self.named(name):
+            return None
+        fields = {'name': name}
+        for browser, rule_name, predicates in self.rules:
+            if rule_name not in name:
+                continue
+            for field, pattern, wanted in predicates:
+                value = fields.get(field)
+                if value is None:
+                    value = fields[field] = read(proc, field)
+                if (pattern.search(value) is not None) != wanted:
+                    break
+            else:
+                return browser
+        return None
+
+# This class is one process as it goes through a scan, and as the cache
+# keeps it afterwards. The slots keep the records of a table of
+# thousands of processes small. seen is the number of the last scan that
+# saw the process, and proc the psutil.Process while the process is
+# being classified; it is dropped once the record is stored.
+class ProcessRecord:
+    __slots__ = ('pid', 'create_time', 'name', 'browser', 'ppid', 'owner',
+                 'root', 'seen', 'proc')
+
+    def __init__(self, pid, create_time=None, proc=None, name=None):
+        self.pid = pid
+        self.create_time = create_time
+        self.name = name
+        self.browser = None
+        self.ppid = None
+        self.owner = None
+        self.root = None
+        self.seen = 0
+        self.proc = proc
+
+# The position of each browser in the per-browser counters.
+BROWSER_INDEX = dict((browser, index)
+                     for index, browser in enumerate(journal.BROWSERS))
+
+# This class holds how many instances and child processes of each
+# browser a user runs, in lists indexed like BROWSERS. They are
+# allocated once for each user, and only ever counted up and down.
+class BrowserCounts:
+    __slots__ = ('instances', 'children')
+
+    def __init__(self):
+        self.instances = [0] * len(journal.BROWSERS)
+        self.children = [0] * len(journal.BROWSERS)
+
+    # Returns the browsers that have any processes, with their numbers
+    # of instances and of child processes.
+    def running(self):
+        running = {}
+        for index, browser in enumerate(journal.BROWSERS):
+            if self.instances[index] or self.children[index]:
+                running[browser] = (self.instances[index],
+                                    self.children[index])
+        return running
+
+# This class remembers the classification of every process we have
+# seen, so that a process is only matched against the rules once in its
+# lifetime. Entries are records keyed on the pid and validated against
+# the create time and the name, both read on every scan, so a reused pid
+# or a process that called exec is classified again. Browser
+# processes are additionally indexed so the running browsers can be
+# read off without walking the whole table, both in total and for each
+# user.
+#
+# Browser processes are kept as trees. A root is a process the rules
+# matched, and is one instance of its browser. A process whose parent is
+# a browser process is a child of the same root; it is never matched
+# against the rules, so the helper and content processes of a browser
+# cost no cmdline or environ reads however many tabs are open.
+class ProcessCache:
+    def __init__(self):
+        self.entries = {}
+        self.tracked = {}
+        self.members = {}
+        self.counts = {}
+        self.user_counts = {}
+        self.matcher = None
+        self.scan = 0
+        self.changes = 0
+        self.running_changes = None
+        self.running_users = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Every scan is numbered, and marks the records it sees with its
+    # number, so that no set of the pids seen has to be built.
+    def begin_scan(self):
+        self.scan += 1
+
+    def known(self, pid, create_time, name):
+        entry = self.entries.get(pid)
+        if (entry is not None and entry.create_time == create_time
+            and entry.name == name):
+            entry.seen = self.scan
+            self.hits += 1
+            return True
+        return False
+
+    # Stores a classified record. A browser process is stored as a root
+    # unless the record names the root it belongs to.
+    def store(self, record):
+        pid = record.pid
+        if pid in self.entries:
+            self.evict(pid)
+        self.misses += 1
+        record.seen = self.scan
+        record.proc = None
+        self.entries[pid] = record
+        browser = record.browser
+        if browser is None:
+            return
+        self.changes += 1
+        self.tracked[pid] = browser
+        self.counts[browser] = self.counts.get(browser, 0) + 1
+        counts = self.user_counts.get(record.owner)
+        if counts is None:
+            counts = self.user_counts[record.owner] = BrowserCounts()
+        index = BROWSER_INDEX[browser]
+        if record.root is None:
+            record.root = pid
+            self.members[pid] = set()
+            counts.instances[index] += 1
+        else:
+            self.members[record.root].add(pid)
+            counts.children[index] += 1
+        matches = scan_counters.matches
+        matches[browser] = matches.get(browser, 0) + 1
+
+    def evict(self, pid):
+        entry = self.entries.pop(pid, None)
+        if entry is None:
+            return
+        self.evictions += 1
+        browser = self.tracked.pop(pid, None)
+        if browser is None:
+            return
+        self.changes += 1
+        self.counts[browser] -= 1
+        if not self.counts[browser]:
+            del self.counts[browser]
+        counts = self.user_counts[entry.owner]
+        index = BROWSER_INDEX[browser]
+        if entry.root == pid:
+            counts.instances[index] -= 1
+            members = self.members.pop(pid)
+        else:
+            counts.children[index] -= 1
+            members = self.members.get(entry.root)
+            if members is not None:
+                members.discard(pid)
+            members = ()
+        # Children that outlive their root are forgotten, and are
+        # classified again by the next scan that sees them.
+        for child in members:
+            self.evict(child)
+
+    # Drops every process that the current scan did not see, and
+    # returns how many processes are left.
+    def sweep(self):
+        scan = self.scan
+        gone = [pid for pid, entry in self.entries.items()
+                if entry.seen != scan]
+        for pid in gone:
+            self.evict(pid)
+        return len(self.entries)
+
+    # Returns the running browsers of every user that has one, with the
+    # number of instances and of child processes of each. Browsers whose
+    # owner we may not know are under None. The result is only built
+    # again once a browser process came or went, and must not be
+    # modified.
+    def running_by_user(self):
+        if self.running_changes != self.changes:
+            running = {}
+            for owner, counts in self.user_counts.items():
+                user_running = counts.running()
+                if user_running:
+                    running[owner] = user_running
+            self.running_users = running
+            self.running_changes = self.changes
+        return self.running_users
+
+    # Returns the root a process belongs to if it is a browser process,
+    # None otherwise.
+    def root_of(self, pid):
+        entry = self.entries.get(pid)
+        if entry is None:
+            return None
+        return entry.root
+
+    # A root is a browser process whose parent is not a browser
+    # process, e.g. the main Firefox process but not its content
+    # processes.
+    def is_root(self, pid):
+        return self.root_of(pid) == pid
+
+    def clear(self):
+        self.entries.clear()
+        self.tracked.clear()
+        self.members.clear()
+        self.counts.clear()
+        self.user_counts.clear()
+        self.changes += 1
+
+process_cache = ProcessCache()
+
+# This function classifies a process read through psutil and fills in
+# its record.
+def classify_process(record, matcher):
+    proc = record.proc
+    name = record.name = proc.name()
+    scan_counters.name_reads += 1
+    if name is not None and matcher.named(name):
+        record.ppid = proc.ppid()
+        classify_named(record, name, matcher)
+    return record
+
+# Fills in the record of a process whose name matches a rule, and whose
+# parent has been read. The process is first looked up in the process
+# tree: if its parent is a process of that browser it is a child of the
+# same root, and the rules are not consulted.
+def classify_named(record, name, matcher):
+    record.root = process_tree_root(record.ppid, name, matcher)
+    if record.root is not None:
+        root = process_cache.entries[record.root]
+        record.browser = root.browser
+        record.owner = root.owner
+    elif matcher.binary:
+        record.browser = matcher.classify(name, record.pid,
+                                          procfs_read_field)
+        if record.browser is not None:
+            record.owner = procfs_read_owner(record.pid)
+    else:
+        record.browser = matcher.classify(name, record.proc, read_field)
+        if record.browser is not None:
+            record.owner = read_owner(record.proc)
+
+# Returns the root of the browser a process with this parent and name
+# belongs to, or None. The name has to fit the browser, so that a
+# browser launched from another one is an instance of its own.
+def process_tree_root(ppid, name, matcher):
+    root = process_cache.root_of(ppid)
+    if root is None:
+        return None
+    if not matcher.names_browser(name, process_cache.tracked[root]):
+        return None
+    scan_counters.tree_hits += 1
+    return root
+
+# The cached classifications are only valid for the rules that produced
+# them, so the cache is emptied whenever another matcher is used. Only a
+# full scan can fill it again: the scans that look at a few processes
+# check stale_matcher and do a full scan instead, otherwise every
+# browser still running would look like it had exited.
+def stale_matcher(matcher):
+    return process_cache.matcher is not matcher
+
+def use_matcher(matcher):
+    if process_cache.matcher is not matcher:
+        process_cache.clear()
+        process_cache.matcher = matcher
+
+# A scan is a pipeline of generators: the processes are listed, their
+# names and start times read, the ones the cache already knows are
+# filtered out, the rest are classified, and the records are reduced
+# into the counters of the cache. No list of the processes is built at
+# any point, and a process the cache knows only has its record marked
+# as seen. Processes that have gone away since the previous scan are
+# evicted at the end. A binary matcher selects the /proc scanner, any
+# other one goes through psutil.
+def scan_processes(matcher):
+    use_matcher(matcher)
+    start = time.perf_counter()
+    process_cache.begin_scan()
+    if scan_pool is not None:
+        records = parallel_classified(matcher)
+    elif matcher.binary:
+        records = procfs_classified(procfs_unknown(procfs_pids()), matcher)
+    else:
+        records = psutil_classified(psutil_unknown(psutil.process_iter()),
+                                    matcher)
+    for record in records:
+        process_cache.store(record)
+    visited = process_cache.sweep()
+    scan_counters.scan_done(time.perf_counter() - start, visited)
+
+# Yields a record for every listed process that the cache does not know.
+def psutil_unknown(procs):
+    for proc in procs:
         try:
-            proc = proc.as_dict()
-       
-            if proc['name'] is None:
+            create_time = proc.create_time()
+            name = proc.name()
+        except psutil.NoSuchProcess as e:
+            scan_counters.no_such_process += 1
+            continue
+        except psutil.AccessDenied as e:
+            scan_counters.access_denied += 1
+            continue
+        scan_counters.name_reads += 1
+        if not process_cache.known(proc.pid, create_time, name):
+            yield ProcessRecord(proc.pid, create_time, proc, name)
+
+# Yields the records classified, leaving out the processes that went
+# away or refused access while they were read.
+def psutil_classified(records, matcher):
+    for record in records:
+        name = record.name
+        if name is not None and matcher.named(name):
+            try:
+                record.ppid = record.proc.ppid()
+            except psutil.NoSuchProcess as e:
+                scan_counters.no_such_process += 1
+                continue
+            except psutil.AccessDenied as e:
+                scan_counters.access_denied += 1
+                continue
+            if not classify_read(record, name, matcher):
                 continue
-            if (firefox['name'] in proc['name'] 
-                and tor['cmdline'] not in str(proc['cmdline'])
-                and not found_firefox):
-                browsers.firefox_running()
-                found['firefox'] = True
-                found_firefox = True
-
-            elif (chrome['name'] in proc['name']
-                and chrome['cmdline'] not in str(proc['cmdline'])
-                and not found_chrome):
-                browsers.chrome_running()
-                found['chrome'] = True
-                found_chrome = True
-
-            elif (safari['name'] in proc['name']
-                and safari['cmdline'] in str(proc['cmdline'])
-                and not found_safari):
-                browsers.safari_running()
-                found['safari'] = True
-                found_safari = True
-
-            elif (tor['name'] in proc['name']
-                and tor['cmdline'] in str(proc['cmdline'])
-                and not found_tor):
-                browsers.tor_running()
-                found['tor'] = True
-                found_tor = True
-
-            elif (opera['name'] in proc['name']
-                and opera['cmdline'] not in str(proc['cmdline'])
-                and not found_opera):
-                browsers.opera_running()
-                found['opera'] = True
-                found_opera = True
+        yield record
+
+"""The following functions make up the parallel scan, for machines
+such as build servers where thousands of processes start between two
+scans. Listing the processes stays on the scanning thread. They are
+split, in pid order, into shards, and a thread pool reads their names
+and start times, which is where such a scan spends its time, blocked in
+reads of /proc. Looking them up in the cache, and classifying the few
+new ones whose name matches a rule, happens back on the scanning thread
+and in pid order, exactly as the serial scan does it, so that a child
+always finds its root in the cache and the result is the same."""
+
+# The thread pool of the parallel scan, if the configuration asks for
+# one, and how many processes a scan has to list before it is used.
+scan_pool = None
+scan_pool_threads = 0
+parallel_threshold = 0
+
+# Every thread gets this many shards, so that a slow shard does not
+# hold the others up.
+SHARDS_PER_THREAD = 4
+
+# Starts the thread pool of the parallel scan. Fewer than two threads
+# means scanning serially.
+def start_scan_pool(threads, threshold):
+    global scan_pool, scan_pool_threads, parallel_threshold
+    parallel_threshold = threshold
+    if threads < 2 or scan_pool is not None:
+        return
+    scan_pool = concurrent_futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='scan')
+    scan_pool_threads = threads
+
+# Yields the records classified, like procfs_classified and
+# psutil_classified, reading the names of the processes on the thread
+# pool when there are enough of them to be worth it.
+def parallel_classified(matcher):
+    if matcher.binary:
+        listed = list(procfs_pids())
+    else:
+        listed = list(psutil.process_iter())
+    if len(listed) < max(parallel_threshold, 2):
+        if matcher.binary:
+            classified = procfs_classified(procfs_unknown(listed), matcher)
+        else:
+            classified = psutil_classified(psutil_unknown(listed), matcher)
+        for record in classified:
+            yield record
+        return
+    shards = scan_pool_threads * SHARDS_PER_THREAD
+    size = -(-len(listed) // shards)
+    futures = [scan_pool.submit(read_names, listed[start:start + size],
+                                matcher)
+               for start in range(0, len(listed), size)]
+    for future in futures:
+        records, counters = future.result()
+        scan_counters.merge(counters)
+        for record in records:
+            if process_cache.known(record.pid, record.create_time,
+                                   record.name):
+                continue
+            name = record.name
+            if (name is None or not matcher.named(name)
+                or classify_read(record, name, matcher)):
+                yield record
+
+# Reads the names and start times of a shard of processes, pids for the
+# /proc scanner and Process objects for psutil, on a thread of the scan
+# pool, and the parents of those a rule could match. Returns the records
+# of the processes that could be read, and the counters of the shard.
+def read_names(listed, matcher):
+    counters = ScanCounters()
+    records = []
+    for item in listed:
+        try:
+            if matcher.binary:
+                record = ProcessRecord(item)
+                record.name, record.ppid, record.create_time = \
+                        procfs_read_stat(item, counters)
+            else:
+                record = ProcessRecord(item.pid, item.create_time(), item,
+                                       item.name())
+                if record.name is not None and matcher.named(record.name):
+                    record.ppid = item.ppid()
+            counters.name_reads += 1
+            records.append(record)
+        except OSError:
+            counters.no_such_process += 1
         except psutil.NoSuchProcess as e:
+            counters.no_such_process += 1
+        except psutil.AccessDenied as e:
+            counters.access_denied += 1
+    return records, counters
+
+# Classifies a process whose name matches a rule, once its name and
+# parent have been read. Returns False if it went away or refused access
+# in the meantime.
+def classify_read(record, name, matcher):
+    try:
+        classify_named(record, name, matcher)
+    except OSError:
+        scan_counters.no_such_process += 1
+        return False
+    except psutil.NoSuchProcess as e:
+        scan_counters.no_such_process += 1
+        return False
+    except psutil.AccessDenied as e:
+        scan_counters.access_denied += 1
+        return False
+    return True
+
+# This function applies a batch of process events to the cache without
+# walking the process list. Started pids are always classified again,
+# because a process that called exec keeps its pid and create time.
+def update_processes(matcher, started, exited):
+    if stale_matcher(matcher):
+        scan_processes(matcher)
+        return
+    for pid in exited:
+        process_cache.evict(pid)
+    for pid in started:
+        process_cache.evict(pid)
+        if matcher.binary:
+            record = ProcessRecord(pid)
+            if procfs_classify(record, matcher):
+                process_cache.store(record)
             continue
-
-    if not found_tor:
-        browsers.tor_off()
-        found['tor'] = False
-    if not found_chrome:
-        browsers.chrome_off()
-        found['chrome'] = False
-    if not found_safari:
-        browsers.safari_off()
-        found['safari'] = False
-    if not found_firefox:
-        browsers.firefox_off()
-        found['firefox'] = False
-    if not found_opera:
-        browsers.opera_off()
-        found['opera'] = False
-
-    return browsers, found
-
-# The following function checks processes on Mac OS. It relies on the 
-# cmdline variables to distinguish the Tor Browser Bundle from Firefox.
-# In addition, it checks to see if a current window is active for any 
+        try:
+            proc = psutil.Process(pid)
+            record = classify_process(
+                    ProcessRecord(pid, proc.create_time(), proc), matcher)
+        except psutil.NoSuchProcess as e:
+            scan_counters.no_such_process += 1
+            continue
+        except psutil.AccessDenied as e:
+            scan_counters.access_denied += 1
+            continue
+        process_cache.store(record)
+
+"""The following functions make up the /proc scanner, an alternative
+to psutil on Linux. It reads /proc/<pid>/stat, which gives the name,
+parent and start time of a process in one read, and /proc/<pid>/cmdline
+only when a rule asks for it. Everything is matched as raw bytes and no
+Process objects are built. A process that vanishes while we read it
+simply raises an OSError that is caught around the read."""
+
+# Returns the name, parent pid and start time (in clock ticks since
+# boot) of a process. The name is taken the same way psutil takes it:
+# the kernel truncates it to 15 characters, so a name that long is
+# completed from the executable in the cmdline where possible. A zombie
+# has exited, and is reported as gone like psutil reports it, rather
+# than matched on the empty cmdline it is left with.
+def procfs_read_stat(pid, counters=None):
+    with open('/proc/%d/stat' % pid, 'rb') as stat_file:
+        data = stat_file.read()
+    end = data.rfind(b')')
+    name = data[data.find(b'(') + 1:end]
+    fields = data[end + 2:].split()
+    if fields[0] == b'Z':
+        raise ProcessLookupError("Process %d is a zombie" % pid)
+    if len(name) >= 15:
+        args = procfs_read_field(pid, 'cmdline', counters).split(b' ')
+        exe = os.path.basename(args[0])
+        if exe.startswith(name):
+            name = exe
+    return name, int(fields[1]), int(fields[19])
+
+# Returns cmdline or environ as bytes with the arguments separated by
+# spaces, which is what read_field returns for psutil. A field we are
+# not allowed to read is empty, as with psutil. Like psutil, we accept
+# processes such as Chrome that rewrite their cmdline with spaces. The
+# threads of the parallel scan count into counters of their own.
+def procfs_read_field(pid, field, counters=None):
+    if counters is None:
+        counters = scan_counters
+    if field == 'cmdline':
+        counters.cmdline_reads += 1
+    elif field == 'environ':
+        counters.environ_reads += 1
+    else:
+        raise Exception("Unknown process field %s" % field)
+    try:
+        with open('/proc/%d/%s' % (pid, field), 'rb') as field_file:
+            data = field_file.read()
+    except PermissionError:
+        counters.access_denied += 1
+        return b''
+    if data.endswith(b'\0') or data.endswith(b' '):
+        data = data[:-1]
+    return data.replace(b'\0', b' ')
+
+# Returns the effective uid of a process, as read_owner does for psutil.
+# It is taken from the Uid line of /proc/<pid>/status (real, effective,
+# saved and filesystem uid). The owner of /proc/<pid> itself won't do:
+# the kernel gives the directory of a process that is not dumpable, such
+# as one that changed its uid, to root.
+def procfs_read_owner(pid):
+    with open('/proc/%d/status' % pid, 'rb') as status_file:
+        for line in status_file:
+            if line.startswith(b'Uid:'):
+                return int(line.split()[2])
+    return None
+
+# Fills in the record of a process from /proc. Returns False if the
+# process went away while it was read.
+def procfs_classify(record, matcher):
+    try:
+        record.name, record.ppid, record.create_time = procfs_read_stat(
+                record.pid)
+    except OSError:
+        scan_counters.no_such_process += 1
+        return False
+    scan_counters.name_reads += 1
+    return not matcher.named(record.name) or classify_read(record,
+            record.name, matcher)
+
+def procfs_pids():
+    with os.scandir('/proc') as entries:
+        for entry in entries:
+            if entry.name.isdigit():
+                yield int(entry.name)
+
+# Yields a record for every pid that the cache does not know under the
+# name and start time it has now, with those and the parent read.
+def procfs_unknown(pids):
+    for pid in pids:
+        try:
+            name, ppid, create_time = procfs_read_stat(pid)
+        except OSError:
+            scan_counters.no_such_process += 1
+            continue
+        scan_counters.name_reads += 1
+        if not process_cache.known(pid, create_time, name):
+            record = ProcessRecord(pid, create_time, None, name)
+            record.ppid = ppid
+            yield record
+
+# Yields the records classified, leaving out the processes that went
+# away while they were read.
+def procfs_classified(records, matcher):
+    for record in records:
+        if (not matcher.named(record.name)
+            or classify_read(record, record.name, matcher)):
+            yield record
+
+# Returns the start time of a process in the units the scanner of the
+# given matcher caches, or None if the process is gone.
+def read_create_time(pid, matcher):
+    if matcher is not None and matcher.binary:
+        try:
+            return procfs_read_stat(pid)[2]
+        except OSError:
+            return None
+    try:
+        return psutil.Process(pid).create_time()
+    except psutil.NoSuchProcess:
+        return None
+
+# Returns the matcher for the scanner selected in the configuration.
+# 'auto' picks the /proc scanner wherever there is a /proc to read.
+def scanner_matcher(variables, scanner):
+    if scanner == 'auto':
+        if platform == "linux" and os.path.exists('/proc/self/stat'):
+            scanner = 'procfs'
+        else:
+            scanner = 'psutil'
+    if scanner == 'procfs':
+        if platform != "linux":
+            raise Exception("The procfs scanner only works on Linux!")
+        return BrowserMatcher(variables, binary=True)
+    elif scanner == 'psutil':
+        return BrowserMatcher(variables)
+    raise Exception("Unknown scanner %s" % scanner)
+
+# The browsers that BrowserState keeps flags for. Rules can only report
+# one of these. Their order is part of the journal format.
+BROWSERS = journal.BROWSERS
+
+# This function brings the BrowserState of a user up to date with the
+# browsers currently running for them. running maps each of them to its
+# numbers of instances and of child processes. Only the browsers that
+# run now or ran before are looked at, and only those that started or
+# stopped are recorded.
+def update_browser_state(browsers, running, user=None):
+    mask = 0
+    for name in running:
+        mask |= BROWSER_BITS[name]
+    flags = browsers.triggers
+    started, stopped = browsers.update(mask)
+    for index in mask_indexes(mask | stopped):
+        name = BROWSERS[index]
+        instances, children = running.get(name, (0, 0))
+        change = browsers.set_counts(index, instances, children)
+        if change == 'opened' or change == 'closed':
+            print("An instance of %s was %s, %d still running"
+                  % (name, change, instances))
+            event = journal.OPENED if change == 'opened' else journal.CLOSED
+            record_transition(index, event, flags, user)
+        bit = 1 << index
+        if (started | stopped) & bit:
+            metrics.transition(name, bool(mask & bit))
+            # The flags as they were right after this browser changed,
+            # like the exits of the browsers before it left them.
+            flags |= exit_triggers(stopped & (bit | (bit - 1)))
+            record_transition(index, int(bool(mask & bit)), flags, user)
+
+# The journal of transitions, when it is turned on.
+transitions = None
+
+# Opens the journal that the configuration asks for.
+def open_journal(config):
+    global transitions
+    options = config.journal_options
+    if not options['file']:
+        return
+    path = os.path.join(os.path.dirname(config.location),
+            os.path.expanduser(options['file']))
+    transitions = journal.Journal(path, options['capacity'])
+
+# The outbox of trigger events, when there is an endpoint to send them to.
+trigger_outbox = None
+
+# Opens the outbox that the configuration asks for.
+def open_outbox(config):
+    global trigger_outbox
+    options = config.outbox_options
+    if not options['endpoint'] or not options['file']:
+        return
+    path = os.path.join(os.path.dirname(config.location),
+            os.path.expanduser(options['file']))
+    trigger_outbox = outbox.Outbox(path)
+
+# Delivers everything in the outbox, a batch at a time.
+def deliver_outbox(sender, limit):
+    while True:
+        lines, end = trigger_outbox.batch(limit)
+        if not lines:
+            return
+        sender.send(lines)
+        trigger_outbox.acknowledge(len(lines), end)
+        metrics.outbox_delivered += len(lines)
+
+def outbox_summary():
+    if trigger_outbox is None:
+        return None
+    return {'pending': trigger_outbox.pending,
+            'delivered': metrics.outbox_delivered,
+            'failures': metrics.outbox_failures}
+
+# Returns where the configuration asks for the control socket, or None.
+def control_path(config):
+    socket = config.control_options['socket']
+    if not socket:
+        return None
+    return os.path.join(os.path.dirname(config.location),
+            os.path.expanduser(socket))
+
+def record_transition(browser, event, flags, user):
+    if transitions is not None:
+        transitions.record(browser, event, flags, journal_user(user))
+
+# Returns the number a user is recorded as in the journal: the uid, or
+# a checksum of the user name on windows.
+def journal_user(user):
+    if user is None:
+        return journal.UNKNOWN_USER
+    if isinstance(user, str):
+        return zlib.crc32(user.encode())
+    return user
+
+# Returns the browsers running for anyone, with their numbers of
+# instances and child processes added up over all users.
+def everyone(running):
+    browsers = {}
+    for user_running in running.values():
+        for browser, (instances, children) in user_running.items():
+            total = browsers.get(browser, (0, 0))
+            browsers[browser] = (total[0] + instances, total[1] + children)
+    return browsers
+
+# Returns the user the monitor runs as, the way read_owner reports
+# users.
+def current_user():
+    if platform == "win32":
+        return psutil.Process().username()
+    return os.geteuid()
+
+# Returns the name of a user.
+def user_name(user):
+    if platform == "win32" or user is None:
+        return str(user)
+    import pwd
+    try:
+        return pwd.getpwuid(user).pw_name
+    except KeyError:
+        return str(user)
+
+# The following function checks processes on Linux distributions. The
+# rules compiled into the matcher rely on the cmdline to distinguish
+# the Tor Browser Bundle from Firefox.
+def ul_process_check(browsers, matcher):
+    update_browser_state(browsers, everyone(ul_process_scan(matcher)))
+    return browsers
+
+# Returns the set of browsers running on Linux for each user.
+def ul_process_scan(matcher):
+    scan_processes(matcher)
+    return process_cache.running_by_user()
+
+# This function keeps the exit watcher in step with the cache, so that
+# exactly the root processes of the tracked browsers are watched. Roots
+# that are already gone by the time we get to them are returned.
+def watch_browser_roots(watcher):
+    gone = set()
+    for pid in watcher.watched():
+        if not process_cache.is_root(pid):
+            watcher.unwatch(pid)
+    for pid in list(process_cache.tracked):
+        if process_cache.is_root(pid) and not watcher.watch(pid):
+            gone.add(pid)
+    return gone
+
+# When a root process exits, its children usually go with it. This
+# function returns the exited pids together with every other process
+# of the same browsers that has gone away, so the browser can be marked
+# as closed without waiting for the next full scan.
+def confirm_exits(exited):
+    browsers = set()
+    for pid in exited:
+        browser = process_cache.tracked.get(pid)
+        if browser is not None:
+            browsers.add(browser)
+    gone = set(exited)
+    for pid, browser in list(process_cache.tracked.items()):
+        if browser not in browsers or pid in gone:
+            continue
+        create_time = read_create_time(pid, process_cache.matcher)
+        if create_time != process_cache.entries[pid].create_time:
+            gone.add(pid)
+    return gone
+
+# Checks only that the root processes of the tracked browsers are still
+# there, evicting those that are gone together with their children.
+# This is the scan of the governor's roots tier: one read for each
+# browser instance rather than for each process, which sees browsers
+# closing but not launching. Returns the running browsers of each user.
+def roots_scan(matcher):
+    if stale_matcher(matcher):
+        return process_scan(matcher)
+    gone = [pid for pid, browser in process_cache.tracked.items()
+            if process_cache.is_root(pid)
+            and read_create_time(pid, matcher)
+                != process_cache.entries[pid].create_time]
+    for pid in gone:
+        process_cache.evict(pid)
+    return process_cache.running_by_user()
+
+# The following function does one step of the event driven scanner on
+# Linux: it applies the pids that the event source and the exit watcher
+# reported as started or exited, or walks the whole process list if
+# asked to or if events were lost. Returns the sets of running browsers
+# of each user and whether the whole list was walked.
+def ul_event_step(events, watcher, matcher, resync):
+    rescanned = False
+    root_exits = set()
+    if watcher is not None:
+        root_exits = watcher.read_events()
+    changes = events.read_events()
+    if changes is None or resync or stale_matcher(matcher):
+        scan_processes(matcher)
+        rescanned = True
+    else:
+        started, exited = changes
+        exited |= confirm_exits(root_exits)
+        if started or exited:
+            update_processes(matcher, started, exited)
+    if watcher is not None:
+        gone = watch_browser_roots(watcher)
+        if gone:
+            update_processes(matcher, set(), confirm_exits(gone))
+    return process_cache.running_by_user(), rescanned
+
+# The following function checks processes on Mac OS. In addition to the
+# classification, it checks to see if a current window is active for any
 # of the browser processes that it finds before assumming that a
 # browser is open because of how Mac handles processes.
-def mac_process_check(browsers, variables, found):
-    firefox = variables['firefox']
-    tor = variables['tor']
-    chrome = variables['chrome']
-    safari = variables['safari']
-    opera = variables['opera']
-
-    found_firefox = False
-    found_tor = False
-    found_chrome = False
-    found_safari = False
-    found_opera = False
-
-    potentially_found = {}
-
+def mac_process_check(browsers, matcher):
+    update_browser_state(browsers, everyone(mac_process_scan(matcher)))
+    return browsers
+
+# How many windows a browser has to own on Mac OS before it counts as
+# running. Edge is not looked for.
+MAC_WINDOW_THRESHOLDS = {'firefox': 3, 'chrome': 3, 'safari': 3, 'tor': 3,
+                         'opera': 4}
+
+# The windows counted for each browser during a Mac OS scan, indexed
+# like BROWSERS and reused from one scan to the next.
+mac_window_counts = [0] * len(journal.BROWSERS)
+
+# Returns the set of browsers running on Mac OS. The window list only
+# shows the windows of our own session, so every browser counts as ours.
+def mac_process_scan(matcher):
+    import Quartz
     print("Going through processes.")
-    for proc in psutil.process_iter():
-        proc = proc.as_dict()
-       
-        if proc['name'] is None:
-            continue
-        if (firefox['name'] in proc['name'] 
-            and tor['cmdline'] not in str(proc['cmdline'])
-            and not found_firefox):
-            print("Firefox potentiall found.")
-            pid = proc['pid']
-            potentially_found[pid] = 'firefox'
-
-        elif (chrome['name'] in proc['name']
-            and chrome['cmdline'] not in str(proc['cmdline'])
-            and not found_chrome):
-            pid = proc['pid']
-            potentially_found[pid] = 'chrome'
-
-        elif (safari['name'] in proc['name']
-            and safari['cmdline'] in str(proc['cmdline'])
-            and not found_safari):
-            pid = proc['pid']
-            potentially_found[pid] = 'safari'
-
-        elif (tor['name'] in proc['name']
-            and tor['cmdline'] in str(proc['cmdline'])
-            and not found_tor):
-            pid = proc['pid']
-            potentially_found[pid] = 'tor'
-
-        elif (opera['name'] in proc['name']
-            and opera['cmdline'] not in str(proc['cmdline'])
-            and not found_opera):
-            pid = proc['pid']
-            potentially_found[pid] = 'opera'
+    scan_processes(matcher)
+    potentially_found = process_cache.tracked
 
     windows = Quartz.CGWindowListCopyWindowInfo(
                 Quartz.kCGWindowListOptionAll,
                 Quartz.kCGNullWindowID)
 
-    potential_firefox_windows = []
-    potential_chrome_windows = []
-    potential_safari_windows = []
-    potential_tor_windows = []
-    potential_opera_windows = []
+    window_counts = mac_window_counts
+    for index in range(len(window_counts)):
+        window_counts[index] = 0
     for window in windows:
-        window_pid = window.valueForKey_('kCGWindowOwnerPID')
-        try:
-            browser_name = potentially_found[window_pid]
-        except KeyError:
-            continue
-        if browser_name == 'firefox':
-            potential_firefox_windows.append(window)
-        elif browser_name == 'chrome':
-            potential_chrome_windows.append(window)
-        elif browser_name == 'safari':
-            potential_safari_windows.append(window)
-        elif browser_name == 'tor':
-            potential_tor_windows.append(window)
-        elif browser_name == 'opera':
-            potential_opera_windows.append(window)
-        else:
-            continue
-
-    print("Firefox:", len(potential_firefox_windows))
-    print("Chrome:", len(potential_chrome_windows))
-    print("Safari:", len(potential_safari_windows))
-    print("Tor:", len(potential_tor_windows))
-    print("Opera:", len(potential_opera_windows))
-
-    if len(potential_firefox_windows) >= 3:
-        browsers.firefox_running()
-        found['firefox'] = True
-        found_firefox = True
-        print("Found Firefox.")
-    if len(potential_chrome_windows) >= 3:
-        browsers.chrome_running()
-        found['chrome'] = True
-        found_chrome = True
-    if len(potential_safari_windows) >= 3:
-        browsers.safari_running()
-        found['safari'] = True
-        found_safari = True
-        print("Found Safari.")
-    if len(potential_tor_windows) >= 3:
-        browsers.tor_running()
-        found['tor'] = True
-        found_tor = True
-    if len(potential_opera_windows) >= 4:
-        browsers.opera_running()
-        found['opera'] = True
-        found_opera = True
-       
-
-    if not found_tor:
-        browsers.tor_off()
-        found['tor'] = False
-    if not found_chrome:
-        browsers.chrome_off()
-        found['chrome'] = False
-    if not found_safari:
-        browsers.safari_off()
-        found['safari'] = False
-    if not found_firefox:
-        browsers.firefox_off()
-        found['firefox'] = False
-    if not found_opera:
-        browsers.opera_off()
-        found['opera'] = False
-
-    return browsers, found
-
-# The following function checks the processes on windows machines. It
-# relies on the 'TOR_BROWSER_TOR_DATA_DIR environment variable in the 
-# 'environ' part of the process dictionary. 
-def windows_process_check(browsers, variables, found):
-    firefox = variables['firefox']
-    tor = variables['tor']
-    chrome = variables['chrome']
-    safari = variables['safari']
-    opera = variables['opera']
-    edge = variables['edge']
-
-    found_firefox = False
-    found_tor = False
-    found_chrome = False
-    found_safari = False
-    found_opera = False
-    found_edge = False
-
-    for proc in psutil.process_iter():
-        try:
-            proc = proc.as_dict()
-
-            if (firefox['name'] in proc['name']
-                and tor['environ'] not in str(proc['environ'])
-                and firefox['cmdline'] not in str(proc['cmdline'])
-                and not found_firefox):
-                browsers.firefox_running()
-                found['firefox'] = True
-                found_firefox = True
-
-            elif (chrome['name'] in proc['name']
-                and chrome['cmdline'] not in str(proc['cmdline'])
-                and not found_chrome):
-                browsers.chrome_running()
-                found['chrome'] = True
-                found_chrome = True
-
-            elif (safari['name'] in proc['name']
-                and not found_safari):
-                browsers.safari_running()
-                found['safari'] = True
-                found_safari = True
-
-            elif (tor['name'] in proc['name']
-                and tor['environ'] in str(proc['environ'])
-                and not found_tor):
-                browsers.tor_running()
-                found['tor'] = True
-                found_tor = True
-
-            elif (opera['name'] in proc['name']
-                and 'crash' not in proc['name']
-                and opera['cmdline'] not in str(proc['cmdline'])
-                and not found_opera):
-                browsers.opera_running()
-                found_opera = True
-                found['opera'] = True
-        
-            elif (edge['name'] in proc['name']
-                and edge['cmdline'] not in str(proc['cmdline'])
-                and not found_edge):
-                browsers.edge_running()
-                found_edge = True
-                found['edge'] = True
-        except psutil.NoSuchProcess as e:
-            continue
-
-    if not found_tor:
-        found['tor'] = False
-        browsers.tor_off()
-    if not found_chrome:
-        found['chrome'] = False
-        browsers.chrome_off()
-    if not found_safari:
-        found['safari'] = False
-        browsers.safari_off()
-    if not found_firefox:
-        found['firefox'] = False
-        browsers.firefox_off()
-    if not found_opera:
-        found['opera'] = False
-        browsers.opera_off()
-    if not found_edge:
-        found['edge'] = False
-        browsers.edge_off()
-
-    return browsers, found
+        browser_name = potentially_found.get(
+                window.valueForKey_('kCGWindowOwnerPID'))
+        if browser_name is not None:
+            window_counts[BROWSER_INDEX[browser_name]] += 1
+
+    user = current_user()
+    counts = process_cache.running_by_user().get(user, {})
+    running = {}
+    for browser_name, threshold in MAC_WINDOW_THRESHOLDS.items():
+        count = window_counts[BROWSER_INDEX[browser_name]]
+        print("%s: %d" % (browser_name, count))
+        if count >= threshold:
+            running[browser_name] = counts.get(browser_name, (1, 0))
+            print("Found %s." % browser_name)
+    return {user: running}
+
+# The following function checks the processes on windows machines. The
+# rules compiled into the matcher rely on the 'TOR_BROWSER_TOR_DATA_DIR'
+# environment variable to distinguish the Tor Browser Bundle.
+def windows_process_check(browsers, matcher):
+    update_browser_state(browsers, everyone(windows_process_scan(matcher)))
+    return browsers
+
+# Returns the set of browsers running on windows machines for each
+# user.
+def windows_process_scan(matcher):
+    scan_processes(matcher)
+    return process_cache.running_by_user()
 
 """The following functions deals with interacting with the 
 configuration file, which stores the participant's identifier, 
 the necessary variables for the platform, and the server url. """
 
+# This function returns where the configuration file is kept on this
+# platform.
+def config_location():
+    if platform == "win32":
+        return str("%s\\tor_measure\\config.cfg" 
+                        % os.environ['APPDATA'])
+    home = str(os.path.expanduser('~'))
+    return home + '/.tor_measure/config'
+
+# Returns what we compare to tell whether the configuration file has
+# changed since it was read: its modification time and size, or None if
+# there is no file.
+def config_stamp(location):
+    try:
+        stat = os.stat(location)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+# The default survey locations.
+SERVER_DEFAULTS = {
+    'url_switched': "https://iu.co1.qualtrics.com/jfe/form/SV_1zUUNkFOq0Hbmux",
+    'url_tor': "https://iu.co1.qualtrics.com/jfe/form/SV_1MlX8ndQNIHKgyp",
+    'url_non_tor': "https://iu.co1.qualtrics.com/jfe/form/SV_1He1PMKCwwIXC0l",
+}
+
+# Browser rules are kept in sections of their own, named after the rule
+# with this prefix, e.g. [RULE firefox]. They are tried in the order
+# they appear in the file.
+RULE_SECTION = "RULE "
+USER_SECTION = "USER "
+
+# Returns a read-only view of a dictionary, and of the dictionaries in
+# it.
+def freeze(options):
+    frozen = {}
+    for key, value in options.items():
+        if isinstance(value, dict):
+            value = freeze(value)
+        frozen[key] = value
+    return types.MappingProxyType(frozen)
+
+# This class holds everything read from the configuration file, parsed
+# and checked once, together with the matcher compiled from its rules.
+# A snapshot is never changed after it is made. When the file changes a
+# new snapshot is made and swapped in as a whole, so a scan always runs
+# with either the old rules or the new ones, and never pays for parsing.
+class ConfigSnapshot:
+    def __init__(self, location, stamp, variables, switched_url, tor_url,
+                 non_tor_url, scanner, users, schedule, metrics_options,
+                 survey_options, journal_options, user_options,
+                 governor_options, parallel_options, control_options,
+                 outbox_options):
+        check_config(variables, switched_url, tor_url, non_tor_url,
+                     users, schedule, metrics_options, survey_options,
+                     journal_options, user_options, governor_options,
+                     parallel_options, outbox_options)
+        values = self.__dict__
+        values['location'] = location
+        values['stamp'] = stamp
+        values['variables'] = freeze(variables)
+        values['switched_url'] = switched_url
+        values['tor_url'] = tor_url
+        values['non_tor_url'] = non_tor_url
+        values['scanner'] = scanner
+        values['users'] = users
+        values['schedule'] = freeze(schedule)
+        values['metrics_options'] = freeze(metrics_options)
+        values['survey_options'] = freeze(survey_options)
+        values['journal_options'] = freeze(journal_options)
+        values['user_options'] = freeze(user_options)
+        values['governor_options'] = freeze(governor_options)
+        values['parallel_options'] = freeze(parallel_options)
+        values['control_options'] = freeze(control_options)
+        values['outbox_options'] = freeze(outbox_options)
+        values['matcher'] = scanner_matcher(self.variables, scanner)
+
+    def __setattr__(self, name, value):
+        raise Exception("The configuration snapshot can't be changed!")
+
+    # Returns the survey settings of a user: their USER section if they
+    # have one, the SURVEY section otherwise.
+    def survey_settings(self, name):
+        return self.user_options.get(name, self.survey_options)
+
+# This function checks the values of a configuration, raising an
+# exception that names the first bad one.
+def check_config(variables, switched_url, tor_url, non_tor_url,
+                 users, schedule, metrics_options, survey_options,
+                 journal_options, user_options, governor_options,
+                 parallel_options, outbox_options):
+    if not variables:
+        raise Exception("No browser rules are configured!")
+    for key, rule in variables.items():
+        if 'name' not in rule:
+            raise Exception("Rule %s has no name" % key)
+        if rule.get('browser', key) not in BROWSERS:
+            raise Exception("Rule %s reports unknown browser %s"
+                            % (key, rule.get('browser', key)))
+    for url in (switched_url, tor_url, non_tor_url):
+        if not url.startswith(('https://', 'http://')):
+            raise Exception("Survey url %s isn't a web address" % url)
+    for key, value in schedule.items():
+        if key == 'jitter':
+            if not 0 <= value < 1:
+                raise Exception("The scheduler jitter must be in [0, 1)")
+        elif key == 'backoff':
+            if value < 1:
+                raise Exception("The scheduler backoff must be at least 1")
+        elif value <= 0:
+            raise Exception("The scheduler %s must be positive" % key)
+    if not 0 <= metrics_options['port'] <= 65535:
+        raise Exception("Bad metrics port %d" % metrics_options['port'])
+    if metrics_options['interval'] <= 0:
+        raise Exception("The metrics interval must be positive")
+    if users not in ('self', 'all'):
+        raise Exception("Unknown users setting %s" % users)
+    for options in [survey_options] + list(user_options.values()):
+        if options['cooldown'] < 0:
+            raise Exception("The survey cooldown can't be negative")
+        if options['policy'] not in ('drop', 'coalesce', 'queue'):
+            raise Exception("Unknown cooldown policy %s" % options['policy'])
+    if journal_options['capacity'] <= 0:
+        raise Exception("The journal capacity must be positive")
+    if governor_options['budget'] < 0:
+        raise Exception("The CPU budget can't be negative")
+    if governor_options['window'] <= 0:
+        raise Exception("The governor window must be positive")
+    if governor_options['max_stretch'] < 1:
+        raise Exception("The governor max_stretch must be at least 1")
+    if not 0 <= governor_options['nice'] <= 19:
+        raise Exception("The governor nice must be in [0, 19]")
+    if parallel_options['scan_threads'] < 0:
+        raise Exception("The number of scan threads can't be negative")
+    if parallel_options['parallel_threshold'] < 0:
+        raise Exception("The parallel threshold can't be negative")
+    endpoint = outbox_options['endpoint']
+    if endpoint and not endpoint.startswith(('https://', 'http://')):
+        raise Exception("Outbox endpoint %s isn't a web address" % endpoint)
+    if outbox_options['batch'] <= 0:
+        raise Exception("The outbox batch must be positive")
+    for key in ('interval', 'timeout'):
+        if outbox_options[key] <= 0:
+            raise Exception("The outbox %s must be positive" % key)
+    if outbox_options['max_backoff'] < outbox_options['interval']:
+        raise Exception("The outbox max_backoff can't be below its interval")
+
 # This function gets the configuration file for unix-like systems. If
 # it doesn't exist, the file is created.
 def get_ul_config():
-    home = str(os.path.expanduser('~'))
-    config_location = home + '/.tor_measure/config'
-    if not os.path.exists(config_location):
-        return generate_config(config_location)
-    return read_config(config_location)
+    location = config_location()
+    if not os.path.exists(location):
+        generate_config(location)
+    return read_config(location)
 
 # This function gets the configuration file for windows systems. If it
 # doesn't exist, the file is created.
 def get_win_config():
-    config_location = str("%s\\tor_measure\\config.cfg" 
-                        % os.environ['APPDATA'])
-    if not os.path.exists(config_location):
-        return generate_config(config_location)
-    return read_config(config_location)
+    location = config_location()
+    if not os.path.exists(location):
+        generate_config(location)
+    return read_config(location)
 
 # This function reads a configuration file and grabs the necessary data
-# out of it. That data is returned in a tuple.
+# out of it. That data is returned in a ConfigSnapshot.
 def read_config(config_file):
-    config_parser = configparser.ConfigParser()
-    config_parser.read(config_file)
-    variables = config_parser.get("PLATFORM", "variables", None)
-    switched_url = config.get_parser.get("SERVER", 
-                "url_switched", 
-                "https://iu.co1.qualtrics.com/jfe/form/SV_1zUUNkFOq0Hbmux")
-    tor_url = config.get_parser.get("SERVER",
-                "url_tor",
-                "https://iu.co1.qualtrics.com/jfe/form/SV_1MlX8ndQNIHKgyp")
-    non_tor_url = config.get_parser.get("SERVER",
-                "url_non_tor",
-                "https://iu.co1.qualtrics.com/jfe/form/SV_1He1PMKCwwIXC0l")
-    return (variables, switched_url, tor_url, non_tor_url) 
+    stamp = config_stamp(config_file)
+    config_parser = configparser.ConfigParser(interpolation=None)
+    with open(config_file) as source:
+        config_parser.read_file(source)
+    switched_url = config_parser.get("SERVER", "url_switched",
+                fallback=SERVER_DEFAULTS['url_switched'])
+    tor_url = config_parser.get("SERVER", "url_tor",
+                fallback=SERVER_DEFAULTS['url_tor'])
+    non_tor_url = config_parser.get("SERVER", "url_non_tor",
+                fallback=SERVER_DEFAULTS['url_non_tor'])
+    scanner = config_parser.get("PLATFORM", "scanner", fallback="auto")
+    users = config_parser.get("PLATFORM", "users", fallback="self")
+    # Files written before the rules had sections of their own get the
+    # default rules.
+    variables = {}
+    for section in config_parser.sections():
+        if section.startswith(RULE_SECTION):
+            key = section[len(RULE_SECTION):].strip()
+            variables[key] = dict(config_parser.items(section))
+    if not variables:
+        variables = default_variables(platform)
+    schedule = read_options(config_parser, "SCHEDULER", SCHEDULE_DEFAULTS)
+    metrics_options = read_options(config_parser, "METRICS",
+                METRICS_DEFAULTS)
+    survey_options = read_options(config_parser, "SURVEY", SURVEY_DEFAULTS)
+    journal_options = read_options(config_parser, "JOURNAL",
+                JOURNAL_DEFAULTS)
+    governor_options = read_options(config_parser, "GOVERNOR",
+                GOVERNOR_DEFAULTS)
+    parallel_options = read_options(config_parser, "PLATFORM",
+                PARALLEL_DEFAULTS)
+    control_options = read_options(config_parser, "CONTROL",
+                CONTROL_DEFAULTS)
+    outbox_options = read_options(config_parser, "OUTBOX", OUTBOX_DEFAULTS)
+    # A user can have survey settings of their own in a section named
+    # after them, e.g. [USER alice]. What it leaves out comes from the
+    # SURVEY section.
+    user_options = {}
+    for section in config_parser.sections():
+        if section.startswith(USER_SECTION):
+            name = section[len(USER_SECTION):].strip()
+            user_options[name] = read_options(config_parser, section,
+                    survey_options)
+    return ConfigSnapshot(config_file, stamp, variables, switched_url,
+                tor_url, non_tor_url, scanner, users, schedule,
+                metrics_options, survey_options, journal_options,
+                user_options, governor_options, parallel_options,
+                control_options, outbox_options)
+
+# Reads the options of a section, converting each one to the type of
+# its default.
+def read_options(config_parser, section, defaults):
+    options = {}
+    for key, value in defaults.items():
+        text = config_parser.get(section, key, fallback=None)
+        if text is None:
+            options[key] = value
+            continue
+        try:
+            options[key] = type(value)(text)
+        except ValueError:
+            raise Exception("Bad value %s for %s in section %s"
+                            % (text, key, section))
+    return options
 
 # This function generates a configuration file when it doesn't exist.
-# It generates a unique identifier and stores the server url and
-# platform variables.
+# It stores the server url, the platform variables and the default
+# settings. The file is written to a temporary name first, so a monitor
+# watching for changes never reads half of it.
 def generate_config(config_location):
     assert(not os.path.exists(config_location))
-    config_parser = configparser.ConfigParser()
+    config_parser = configparser.ConfigParser(interpolation=None)
     config_parser.add_section("SERVER")
+    for key, value in SERVER_DEFAULTS.items():
+        config_parser.set("SERVER", key, value)
     config_parser.add_section("PLATFORM")
-    switched_url = "https://iu.co1.qualtrics.com/jfe/form/SV_1zUUNkFOq0Hbmux"
-    tor_url = "https://iu.co1.qualtrics.com/jfe/form/SV_1MlX8ndQNIHKgyp"
-    non_tor_url = "https://iu.co1.qualtrics.com/jfe/form/SV_1He1PMKCwwIXC0l"
-    config_parser.set("SERVER", "url_switched", switched_url)
-    config_parser.set("SERVER", "url_tor", tor_url)
-    config_parser.set("SERVER", "url_non_tor", non_tor_url)
+    # The process scanner to use: psutil, procfs (Linux only) or auto.
+    config_parser.set("PLATFORM", "scanner", "auto")
+    # Whose browsers to follow: self, or all users when the monitor
+    # runs once for the whole system.
+    config_parser.set("PLATFORM", "users", "self")
+    for key, value in PARALLEL_DEFAULTS.items():
+        config_parser.set("PLATFORM", key, str(value))
+    for section, defaults in (("SCHEDULER", SCHEDULE_DEFAULTS),
+                              ("METRICS", METRICS_DEFAULTS),
+                              ("SURVEY", SURVEY_DEFAULTS),
+                              ("JOURNAL", JOURNAL_DEFAULTS),
+                              ("GOVERNOR", GOVERNOR_DEFAULTS),
+                              ("CONTROL", CONTROL_DEFAULTS),
+                              ("OUTBOX", OUTBOX_DEFAULTS)):
+        config_parser.add_section(section)
+        for key, value in defaults.items():
+            config_parser.set(section, key, str(value))
+    for key, rule in default_variables(platform).items():
+        config_parser.add_section(RULE_SECTION + key)
+        for option, value in rule.items():
+            config_parser.set(RULE_SECTION + key, option, value)
+
+    directory = os.path.dirname(config_location)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = config_location + '.tmp'
+    with open(temporary, 'w') as output:
+        config_parser.write(output)
+    os.replace(temporary, config_location)
+
+# This function returns the default browser rules for a platform. The
+# rules are tried in this order; see BrowserMatcher for what the
+# options mean.
+def default_variables(system):
     variables = {}
-
-    if platform == "linux":
-        variables['firefox'] = {'name':'firefox'}
-        variables['tor'] = {'name':'firefox', 'cmdline':'Tor Browser'}
-        variables['chrome'] = {'name':'chrome', 'cmdline':'--type'}
-        variables['chromium'] = {'name':'chromium', 'cmdline':'--type'}
+    if system == "linux":
+        variables['firefox'] = {'name':'firefox',
+                'not_cmdline':'Tor Browser'}
+        variables['chrome'] = {'name':'chrome', 'not_cmdline':'--type'}
+        variables['chromium'] = {'name':'chromium', 'not_cmdline':'--type',
+                'browser':'chrome'}
         variables['safari'] = {'name':'Safari', 'cmdline':'Safari.app'}
-        variables['opera'] = {'name':'opera', 'cmdline':'--type'}
+        variables['tor'] = {'name':'firefox', 'cmdline':'Tor Browser'}
+        variables['opera'] = {'name':'opera', 'not_cmdline':'--type'}
 
-    elif platform == "darwin":
+    elif system == "darwin":
+        variables['firefox'] = {'name':'firefox',
+                'not_cmdline':'TorBrowser'}
+        variables['chrome'] = {'name':'Chrome', 'not_cmdline':'--type'}
         variables['safari'] = {'name':'Safari', 'cmdline':'Safari.app'}
-        variables['firefox'] = {'name':'firefox'}
-        variables['chrome'] = {'name':'Chrome', 'cmdline':'--type'}
         variables['tor'] = {'name':'firefox', 'cmdline':'TorBrowser'}
-        variables['opera'] = {'name':'Opera', 'cmdline':'--type'}
+        variables['opera'] = {'name':'Opera', 'not_cmdline':'--type'}
 
-    elif platform == "win32":
+    elif system == "win32":
         variables['firefox'] = {'name':'firefox',
-                'cmdline':'-contentproc'}
-        variables['tor'] = {'name':'firefox', 
+                'not_cmdline':'-contentproc',
+                'not_environ':'TOR_BROWSER_TOR_DATA_DIR'}
+        variables['chrome'] = {'name':'chrome', 'not_cmdline':'--type'}
+        variables['safari'] = {'name':'safari'}
+        variables['tor'] = {'name':'firefox',
                 'environ':'TOR_BROWSER_TOR_DATA_DIR'}
-        variables['chrome'] = {'name':'chrome', 'cmdline':'--type'}
-        variables['safari'] = {'name':'safari', 'cmdline':'Safari.app'}
-        variables['opera'] = {'name':'opera', 'cmdline':'--type'}
-        variables['edge'] = {'name':'Edge', 'cmdline':'microsoftedgecp'}# TODO: Fill me
+        variables['opera'] = {'name':'opera', 'not_name':'crash',
+                'not_cmdline':'--type'}
+        variables['edge'] = {'name':'Edge', 'not_cmdline':'microsoftedgecp'}# TODO: Fill me
 
     else:
         raise Exception("System not supported!")
 
-    return (variables, switched_url, tor_url, non_tor_url) 
+    return variables
+
+# Returns the command that opens a web page in the session of a user.
+# A monitor that runs for the whole system opens it as that user,
+# through their systemd user manager on Linux and launchctl on Mac OS.
+def survey_opener(user):
+    opener = ["open"] if platform == "darwin" else ["xdg-open"]
+    if user is None or user == current_user():
+        return opener
+    name = user_name(user)
+    if platform == "darwin":
+        return ["launchctl", "asuser", str(user), "sudo", "-u", name] + opener
+    return (["systemd-run", "--user", "--machine=%s@" % name, "--quiet"]
+            + opener)
 
 def ul_display_survey(browsers, which, tor_url, 
-                    switched_url, non_tor_url):
-    opener = "open" if platform == "darwin" else "xdg-open"
+                    switched_url, non_tor_url, user=None):
+    import subprocess
+    opener = survey_opener(user)
     if which == browsers.TOR:
-        res = subprocess.call([opener, tor_url])
+        res = subprocess.call(opener + [tor_url])
     elif which == browsers.SWITCHED:
-        res = subprocess.call([opener, switched_url])
+        res = subprocess.call(opener + [switched_url])
     elif which == browsers.NONTOR:
-        res = subprocess.call([opener, non_tor_url]) 
+        res = subprocess.call(opener + [non_tor_url]) 
     else:
         raise Exception("NO IDEA HOW WE GOT HERE")
 
     if res != 0:
         print(res)
         raise Exception("BROWSER COULDN'T OPEN")
-    LASTSURVEY = time.time()
-    browsers.reset()
-    time.sleep(SLEEPTIME)
 
 def win_display_survey(browsers, which, tor_url,
-                    switched_url, non_tor_url):
+                    switched_url, non_tor_url, user=None):
+    if user is not None and user != current_user():
+        raise Exception("Can't display a survey in the session of %s!"
+                        % user)
+    import webbrowser
     if which == browsers.TOR:
         res = webbrowser.open(tor_url, new=2)
     elif which == browsers.SWITCHED:
@@ -574,38 +2753,56 @@ def win_display_survey(browsers, which, tor_url,
 
     if not res:
         raise Exception("Couldn't open web browser!")
-    LASTSURVEY = time.time()
-    browsers.reset()
-    time.sleep(SLEEPTIME)
-
-if platform == "linux" or platform == "darwin":
-    process_check = ul_process_check
-    variables, switched_url, tor_url, non_tor_url = get_ul_config()
-    display_survey = ul_display_survey
-if platform == "darwin":
-    process_check = mac_process_check
-    import Quartz
-elif platform == "win32":
-    process_check = windows_process_check
-    variables, switched_url, tor_url, non_tor_url = get_win_config()
-    display_survey = win_display_survey
 
-if platform == 'linux' or platform == 'darwin':
-    #import daemon
-    import subprocess
-    #install_file = open('/usr/local/tor_monitor/installed','r')
-    #uid = int(install_file.readline().strip('\n'))
-    #working_dir = install_file.readline().strip('\n')
-    #stdout = open(working_dir + 'output', 'w+')
-    #stderr = open(working_dir + 'errors', 'w+')
-    #pidfile = open(working_dir + '.lock_file')
-    #context = daemon.DaemonContext(#pidfile=pidfile,
-    #                                working_directory=working_dir,
-    #                                uid=uid,
-    #                                stdout=stdout,
-    #                                stderr=stderr)
-    #with context:
+# The functions of the platform we run on, and the configuration. These
+# are set by main(), so that importing this file does nothing.
+process_check = None
+process_scan = None
+root_scan = None
+event_scan = None
+display_survey = None
+config = None
+
+# The window list decides what runs on Mac OS, so it has no roots tier.
+def select_platform():
+    global process_check, process_scan, root_scan, event_scan
+    global display_survey
+    if platform == "linux":
+        process_check = ul_process_check
+        process_scan = ul_process_scan
+        root_scan = roots_scan
+        event_scan = ul_event_step
+        display_survey = ul_display_survey
+    elif platform == "darwin":
+        process_check = mac_process_check
+        process_scan = mac_process_scan
+        display_survey = ul_display_survey
+    elif platform == "win32":
+        process_check = windows_process_check
+        process_scan = windows_process_scan
+        root_scan = roots_scan
+        display_survey = win_display_survey
+    else:
+        raise Exception("System not supported!")
+
+# Reads the configuration file of this platform, creating it if needed.
+def load_config():
+    if platform == "win32":
+        return get_win_config()
+    return get_ul_config()
+
+#import daemon
+#install_file = open('/usr/local/tor_monitor/installed','r')
+#uid = int(install_file.readline().strip('\n'))
+#working_dir = install_file.readline().strip('\n')
+#stdout = open(working_dir + 'output', 'w+')
+#stderr = open(working_dir + 'errors', 'w+')
+#pidfile = open(working_dir + '.lock_file')
+#context = daemon.DaemonContext(#pidfile=pidfile,
+#                                working_directory=working_dir,
+#                                uid=uid,
+#                                stdout=stdout,
+#                                stderr=stderr)
+#with context:
+if __name__ == "__main__":
     main()
-elif platform == 'win32':
-    import webbrowser
-    main() 
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+File: process_trace.py
+
+Description:
+Records the process table of a machine to a trace file, and replays
+such a trace through the scanners and BrowserState of
+process_monitor.py. This is how field reports such as a survey firing
+twice or a closed Tor Browser going unnoticed are reproduced: the
+participant records a trace while it happens, and the trace is
+replayed anywhere, as often as needed, far faster than real time.
+
+A trace is a gzip compressed file of JSON lines. The first line holds
+the platform, the browser rules and the survey settings of the
+recording machine. Every other line is one snapshot of the process
+table, stored as the difference to the previous one: the pids that
+went away and the processes that appeared or changed. For every process
+we keep the pid, parent pid, name, create time and owner. The cmdline,
+and the environment variables the rules look at, are only kept for the
+processes whose name matches a rule, which are the only ones the
+scanners ever read them for.
+
+A trace replays with the scanner of the platform it was recorded on, so
+a trace from a Windows machine replays through windows_process_check on
+Linux. Mac OS traces replay through the process rules alone, as the
+window list cannot be recorded.
+
+Example:
+    python3 process_trace.py record trace.gz --interval 1
+    python3 process_trace.py replay trace.gz
+"""
+import argparse
+import gzip
+import json
+import sys
+import time
+
+import psutil
+
+import process_monitor
+from bench_scan import UIDS, FakeProcess, synthetic_psutil
+
+VERSION = 1
+
+# Returns the process table as a map from pid to the recorded fields:
+# ppid, name, create time, owner, cmdline and environment.
+def snapshot(matcher, environ_patterns):
+    table = {}
+    for proc in psutil.process_iter():
+        try:
+            with proc.oneshot():
+                name = proc.name()
+                entry = [proc.ppid(), name, proc.create_time(),
+                         process_monitor.read_owner(proc), None, None]
+                if name and matcher.named(name):
+                    entry[4] = process_monitor.read_cmdline(proc)
+                    if environ_patterns:
+                        entry[5] = recorded_environ(proc, environ_patterns)
+        except psutil.NoSuchProcess:
+            continue
+        except psutil.AccessDenied:
+            continue
+        table[proc.pid] = entry
+    return table
+
+# Returns the environment variables of a process that a rule could
+# match, and nothing else.
+def recorded_environ(proc, patterns):
+    environ = process_monitor.read_environ(proc)
+    if not environ:
+        return environ
+    kept = {}
+    for key, value in environ.items():
+        item = '%s=%s' % (key, value)
+        for pattern in patterns:
+            if pattern in item:
+                kept[key] = value
+                break
+    return kept
+
+# Returns the substrings the environ rules look for.
+def environ_patterns(variables):
+    patterns = []
+    for rule in variables.values():
+        for option in ('environ', 'not_environ'):
+            if option in rule:
+                patterns.append(rule[option])
+    return patterns
+
+# Records snapshots every interval seconds until the duration is over,
+# or until interrupted.
+def record(path, interval, duration):
+    config = process_monitor.load_config()
+    matcher = process_monitor.BrowserMatcher(config.variables)
+    patterns = environ_patterns(config.variables)
+    header = {'version': VERSION,
+              'platform': sys.platform,
+              'recorded': time.time(),
+              'interval': interval,
+              'rules': dict((key, dict(rule)) for key, rule
+                            in config.variables.items()),
+              'survey': dict(config.survey_options)}
+    previous = {}
+    snapshots = 0
+    end = time.time() + duration if duration else None
+    with gzip.open(path, 'wt') as trace:
+        trace.write(json.dumps(header) + '\n')
+        try:
+            while end is None or time.time() < end:
+                now = time.time()
+                table = snapshot(matcher, patterns)
+                gone = [pid for pid in previous if pid not in table]
+                new = [[pid] + entry for pid, entry in table.items()
+                       if previous.get(pid) != entry]
+                trace.write(json.dumps({'time': now, 'gone': gone,
+                                        'new': new}) + '\n')
+                previous = table
+                snapshots += 1
+                time.sleep(max(0, now + interval - time.time()))
+        except KeyboardInterrupt:
+            pass
+    print("Recorded %d snapshots to %s" % (snapshots, path))
+
+# This class is a recorded process, served to the scanners in place of
+# a psutil.Process.
+class ReplayProcess(FakeProcess):
+    def __init__(self, pid, ppid, name, create_time, owner, cmdline,
+                 environ):
+        FakeProcess.__init__(self, pid, ppid, name, cmdline or [],
+                             environ or {})
+        self._create_time = create_time
+        self.owner = owner
+
+    def uids(self):
+        return UIDS(self.owner, self.owner, self.owner)
+
+    def username(self):
+        return self.owner
+
+# This class holds the process table of a trace as it is replayed, and
+# serves it the way psutil does.
+class ReplayTable:
+    def __init__(self):
+        self.procs = {}
+
+    def apply(self, delta):
+        for pid in delta['gone']:
+            self.procs.pop(pid, None)
+        for pid, ppid, name, create_time, owner, cmdline, environ \
+                in delta['new']:
+            self.procs[pid] = ReplayProcess(pid, ppid, name, create_time,
+                                            owner, cmdline, environ)
+
+    def process_iter(self, attrs=None, ad_value=None):
+        for pid in sorted(self.procs):
+            yield self.procs[pid]
+
+    def Process(self, pid):
+        proc = self.procs.get(pid)
+        if proc is None:
+            raise psutil.NoSuchProcess(pid)
+        return proc
+
+# The scanner that replays the traces of each platform.
+REPLAY_SCANNERS = {
+    'linux': process_monitor.ul_process_check,
+    'darwin': process_monitor.ul_process_check,
+    'win32': process_monitor.windows_process_check,
+}
+
+# Replays a trace through the scanner of its platform and a
+# BrowserState set up like the recording machine's, printing every
+# transition and survey at the time it happened in the trace. The
+# surveys are decided the way the monitor decides them, with the trace
+# times as the clock, so cooldowns play out as they did. Returns the
+# numbers of snapshots and surveys, the span of the trace in seconds
+# and the time the replay took.
+def replay(path, rules=None, quiet=False):
+    with gzip.open(path, 'rt') as trace:
+        header = json.loads(trace.readline())
+        if header['version'] != VERSION:
+            raise Exception("Unknown trace version %s" % header['version'])
+        system = header['platform']
+        if system not in REPLAY_SCANNERS:
+            raise Exception("Can't replay a trace from %s" % system)
+        check = REPLAY_SCANNERS[system]
+        if rules == 'default':
+            variables = process_monitor.default_variables(system)
+        else:
+            variables = header['rules']
+        matcher = process_monitor.BrowserMatcher(variables)
+        browsers = process_monitor.BrowserState()
+        browsers.cooldown = header['survey']['cooldown']
+        browsers.policy = header['survey']['policy']
+        table = ReplayTable()
+        process_monitor.process_cache = process_monitor.ProcessCache()
+        snapshots = 0
+        surveys = 0
+        first = last = None
+        start = time.perf_counter()
+        with synthetic_psutil(table):
+            for line in trace:
+                delta = json.loads(line)
+                table.apply(delta)
+                now = delta['time']
+                if first is None:
+                    first = now
+                last = now
+                running = browsers.running
+                check(browsers, matcher)
+                changed = running ^ browsers.running
+                if changed and not quiet:
+                    for index in process_monitor.mask_indexes(changed):
+                        print("%10.1fs %s %s" % (now - first,
+                              process_monitor.BROWSERS[index],
+                              'running' if browsers.running >> index & 1
+                              else 'off'))
+                which = browsers.survey_due(browsers.triggered_survey(), now)
+                if which is not None:
+                    browsers.displayed(now)
+                    surveys += 1
+                    if not quiet:
+                        print("%10.1fs Displaying %s survey" % (now - first,
+                              process_monitor.SURVEY_NAMES[which]))
+                snapshots += 1
+        seconds = time.perf_counter() - start
+    span = last - first if snapshots else 0.0
+    return snapshots, surveys, span, seconds
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Record the process table, or replay a recording.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    recorder = commands.add_parser('record', help="record a trace")
+    recorder.add_argument('trace')
+    recorder.add_argument('--interval', type=float, default=1.0,
+                          help="seconds between two snapshots")
+    recorder.add_argument('--duration', type=float, default=0,
+                          help="seconds to record for, or until ^C")
+    replayer = commands.add_parser('replay', help="replay a trace")
+    replayer.add_argument('trace')
+    replayer.add_argument('--rules', choices=['recorded', 'default'],
+                          default='recorded',
+                          help="replay with the rules of the recording "
+                               "machine or the default ones")
+    replayer.add_argument('--quiet', action='store_true',
+                          help="only print the summary")
+    args = parser.parse_args()
+    if args.command == 'record':
+        record(args.trace, args.interval, args.duration)
+        return
+    snapshots, surveys, span, seconds = replay(args.trace, args.rules,
+                                               args.quiet)
+    print("Replayed %d snapshots covering %.0fs in %.2fs: %.0f snapshots/s, "
+          "%.0fx real time, %d surveys" % (snapshots, span, seconds,
+          snapshots / seconds if seconds else 0,
+          span / seconds if seconds else 0, surveys))
+
+if __name__ == "__main__":
+    main()